@@ -0,0 +1,310 @@
+"""
+Cold storage for inactive plans, rehydrated on first access.
+
+`archive_inactive_plans` (run nightly by the `archive_plans` timer function)
+moves out plans none of whose documents changed in `ARCHIVE_AFTER_DAYS` (app
+setting, default 180), judged by `lastUpdatedAt` and op times. All of the
+plan's documents are written as gzipped NDJSON to
+`ARCHIVE_DIR/<plan>.ndjson.gz` and deleted, except the plan document, which
+stays as a stub:
+
+    {"plan": ..., "id": <plan>, "type": "plan", "planName": ..., ...,
+     "archived": {"at": <ms>, "file": "<plan>.ndjson.gz", "bytes": ...,
+                  "rawBytes": ..., "documents": ..., "dates": ...,
+                  "activities": ..., "firstDate": ..., "lastDate": ...}}
+
+`rehydrate` writes the documents back and removes the file; routes that
+read a plan call it when they meet a stub, so an archived plan costs one
+slower read and is then hot again. If the archive can't be found they
+answer 503 rather than serve the stub. `metrics()` reports archive sizes and
+rehydration latency.
+
+Plan documents aren't touched by edits, so a plan found to be still active
+gets its last change recorded as `activeAt` on its plan document, and isn't
+read again until that is old enough too.
+
+Nothing is archived unless `ARCHIVE_DIR` is set, since archives must outlive
+the instance: in Azure, point it at a mounted file share. At most
+`ARCHIVE_MAX_PLANS` (default 100) plans are archived and `ARCHIVE_MAX_CHECKED`
+(default 1000) read per run.
+
+    python archive.py run [--days N] [--limit N] [--max-checked N]
+    python archive.py restore PLAN_ID
+"""
+import argparse
+import gzip
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+from models import parse_date_id
+from plan_index import plan_ids
+from plan_io import (
+    MAX_BATCH_SIZE,
+    import_documents,
+    iter_ndjson,
+    iter_ndjson_documents,
+    iter_plan_documents,
+)
+from storage import get_container, read_document
+
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", 180))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR")
+MAX_PLANS_PER_RUN = int(os.environ.get("ARCHIVE_MAX_PLANS", 100))
+MAX_CHECKED_PER_RUN = int(os.environ.get("ARCHIVE_MAX_CHECKED", 1000))
+
+# An old lastUpdatedAt (and activeAt) only makes a plan a candidate; its
+# other documents decide
+CANDIDATES_QUERY = (
+    "SELECT VALUE c.plan FROM c WHERE c.type = 'plan' "
+    "AND c.lastUpdatedAt < @cutoff "
+    "AND (NOT IS_DEFINED(c.activeAt) OR c.activeAt < @cutoff) "
+    "AND NOT IS_DEFINED(c.archived)"
+)
+
+
+class ArchiveUnavailableError(Exception):
+    """
+    An archived plan's documents can't be restored (its file is missing).
+    """
+
+
+_lock = threading.Lock()
+# Held while a plan is being rehydrated
+_plan_locks: Dict[str, threading.Lock] = {}
+stats = {
+    "archived": 0,
+    "archivedBytes": 0,
+    "archivedRawBytes": 0,
+    "archivedDocuments": 0,
+    "rehydrated": 0,
+    "rehydrateMsTotal": 0.0,
+    "rehydrateMsMax": 0.0,
+    "failed": 0,
+}
+
+
+def archive_path(plan_id: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{quote(plan_id, safe='')}.ndjson.gz")
+
+
+def last_updated(docs: List[dict]) -> int:
+    """
+    When a plan's documents last changed, in ms.
+    """
+    return max(
+        (doc.get("at", 0) if doc["type"] == "op" else doc.get("lastUpdatedAt") or 0)
+        for doc in docs
+        if doc["type"] in ("plan", "date", "activity", "op")
+    )
+
+
+def _write_archive(path: str, docs: List[dict]) -> int:
+    """
+    Write the documents to `path` atomically; returns the uncompressed size.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    raw_bytes = 0
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for line in iter_ndjson(docs):
+            raw_bytes += f.write(line)
+    os.replace(tmp, path)
+    return raw_bytes
+
+
+def archive_plan(container, plan_id: str, cutoff: int) -> Optional[dict]:
+    """
+    Archive one plan unless it changed since `cutoff` (ms); returns the
+    stub's `archived` field, or None if the plan was left alone.
+    """
+    docs = list(iter_plan_documents(container, plan_id))
+    plan_doc = next((x for x in docs if x["id"] == plan_id), None)
+    if plan_doc is None or plan_doc.get("archived"):
+        return None
+    active_at = last_updated(docs)
+    if active_at >= cutoff:
+        # Not a candidate again until this is old enough as well
+        container.patch_item(
+            item=plan_id,
+            partition_key=plan_id,
+            patch_operations=[{"op": "set", "path": "/activeAt", "value": active_at}],
+        )
+        return None
+
+    path = archive_path(plan_id)
+    raw_bytes = _write_archive(path, docs)
+    date_ids = sorted(x["id"] for x in docs if x["type"] == "date")
+    archived = {
+        "at": int(time.time() * 1000),
+        "file": os.path.basename(path),
+        "bytes": os.path.getsize(path),
+        "rawBytes": raw_bytes,
+        "documents": len(docs),
+        "dates": len(date_ids),
+        "activities": sum(1 for x in docs if x["type"] == "activity"),
+        "firstDate": parse_date_id(date_ids[0]) if date_ids else None,
+        "lastDate": parse_date_id(date_ids[-1]) if date_ids else None,
+    }
+
+    # The stub goes first, so the plan never looks live with documents missing
+    container.upsert_item(dict(plan_doc, archived=archived))
+    others = [x["id"] for x in docs if x["id"] != plan_id]
+    for i in range(0, len(others), MAX_BATCH_SIZE):
+        container.execute_item_batch(
+            [("delete", (doc_id,)) for doc_id in others[i : i + MAX_BATCH_SIZE]],
+            partition_key=plan_id,
+        )
+    plan_ids.forget(plan_id)
+
+    with _lock:
+        stats["archived"] += 1
+        stats["archivedBytes"] += archived["bytes"]
+        stats["archivedRawBytes"] += raw_bytes
+        stats["archivedDocuments"] += len(docs)
+    return archived
+
+
+def archive_inactive_plans(
+    days: float = ARCHIVE_AFTER_DAYS,
+    limit: int = MAX_PLANS_PER_RUN,
+    max_checked: int = MAX_CHECKED_PER_RUN,
+) -> dict:
+    if not ARCHIVE_DIR:
+        raise RuntimeError("ARCHIVE_DIR must point at durable storage to archive")
+    container = get_container()
+    cutoff = int((time.time() - days * 86400) * 1000)
+    candidates = container.query_items(
+        CANDIDATES_QUERY,
+        parameters=[{"name": "@cutoff", "value": cutoff}],
+        enable_cross_partition_query=True,
+    )
+    summary = {"checked": 0, "archived": 0, "bytes": 0, "failed": 0}
+    for plan_id in candidates:
+        if summary["archived"] >= limit or summary["checked"] >= max_checked:
+            break
+        summary["checked"] += 1
+        try:
+            archived = archive_plan(container, plan_id, cutoff)
+        except Exception:
+            logging.exception(f"Failed to archive plan {plan_id}")
+            summary["failed"] += 1
+            with _lock:
+                stats["failed"] += 1
+            continue
+        if archived:
+            summary["archived"] += 1
+            summary["bytes"] += archived["bytes"]
+    return summary
+
+
+def _restore(plan_id: str) -> Optional[int]:
+    """
+    Write an archived plan's documents back; returns how many, or None if
+    it isn't archived (any more).
+    """
+    container = get_container()
+    stub = read_document(plan_id, plan_id)
+    if not stub or not stub.get("archived"):
+        # Rehydrated meanwhile
+        return None
+    path = archive_path(plan_id) if ARCHIVE_DIR else None
+    if path is None or not os.path.exists(path):
+        logging.error(f"Archive of plan {plan_id} not found at {path}")
+        raise ArchiveUnavailableError(f"Archive of plan {plan_id} is unavailable")
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        docs = list(iter_ndjson_documents(f))
+
+    plan_doc = next(x for x in docs if x["id"] == plan_id)
+    result = import_documents(container, [x for x in docs if x["id"] != plan_id])
+    if result["failed"]:
+        with _lock:
+            stats["failed"] += 1
+        raise RuntimeError(
+            f"Failed to restore {result['failed']} documents of plan {plan_id}"
+        )
+    # Replacing the stub last marks the plan live again
+    container.upsert_item(plan_doc)
+    os.remove(path)
+    plan_ids.forget(plan_id)
+    return len(docs)
+
+
+def rehydrate(plan_id: str) -> None:
+    """
+    Bring an archived plan back into the container, raising
+    ArchiveUnavailableError if its archive is missing. Requests for the same
+    plan wait for one restore; other plans are restored alongside.
+    """
+    start = time.perf_counter()
+    with _lock:
+        plan_lock = _plan_locks.setdefault(plan_id, threading.Lock())
+    with plan_lock:
+        try:
+            restored = _restore(plan_id)
+        finally:
+            with _lock:
+                if _plan_locks.get(plan_id) is plan_lock:
+                    del _plan_locks[plan_id]
+    if restored is None:
+        return
+
+    ms = (time.perf_counter() - start) * 1000
+    with _lock:
+        stats["rehydrated"] += 1
+        stats["rehydrateMsTotal"] += ms
+        stats["rehydrateMsMax"] = max(stats["rehydrateMsMax"], ms)
+    logging.info(f"Rehydrated plan {plan_id}: {restored} documents in {ms:.1f} ms")
+
+
+def metrics() -> dict:
+    with _lock:
+        return dict(
+            stats,
+            rehydrateMsTotal=round(stats["rehydrateMsTotal"], 1),
+            rehydrateMsMax=round(stats["rehydrateMsMax"], 1),
+            compressionRatio=(
+                round(stats["archivedRawBytes"] / stats["archivedBytes"], 2)
+                if stats["archivedBytes"]
+                else None
+            ),
+            rehydrateMsAvg=(
+                round(stats["rehydrateMsTotal"] / stats["rehydrated"], 1)
+                if stats["rehydrated"]
+                else None
+            ),
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Archive or restore plans")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Archive inactive plans")
+    run_parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS)
+    run_parser.add_argument("--limit", type=int, default=MAX_PLANS_PER_RUN)
+    run_parser.add_argument("--max-checked", type=int, default=MAX_CHECKED_PER_RUN)
+    restore_parser = commands.add_parser("restore", help="Rehydrate one plan")
+    restore_parser.add_argument("plan_id")
+    args = parser.parse_args(argv)
+    if not ARCHIVE_DIR:
+        parser.error("ARCHIVE_DIR is not set")
+
+    if args.command == "run":
+        print(archive_inactive_plans(args.days, args.limit, args.max_checked))
+    else:
+        try:
+            rehydrate(args.plan_id)
+        except ArchiveUnavailableError as e:
+            print(e, file=sys.stderr)
+            return 1
+    print(metrics())
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
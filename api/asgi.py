@@ -0,0 +1,385 @@
+"""
+Serve the function app's HTTP routes as an ASGI app, without the Functions
+host.
+
+Routes, methods and bindings are read from the decorators in
+function_app.py. Input bindings are resolved and output bindings written by
+a provider per binding type (see `BindingProvider`), so the same handlers
+run against Cosmos DB, a local hub or anything else plugged in.
+
+Usage (needs `pip install uvicorn`):
+    python asgi.py [--host 0.0.0.0] [--port 7071] [--workers N] [--hub]
+
+`--hub` (or the `HUB_ENABLED` setting) serves realtime messages through the
+built-in hub at /hub, whose state lives in one process, so it needs a single
+worker. `--workers` defaults to one process per CPU, or one with the hub.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import azure.functions as func
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.functions.decorators.core import BindingDirection
+from azure.functions.decorators.function_app import FunctionBuilder
+
+import function_app
+from hub import BroadcastHub
+from signalr_tokens import use_local_hub
+from streaming import StreamingHttpResponse
+from storage import get_container, strip_system_properties
+
+ROUTE_PREFIX = "/api"
+HUB_PATH = "/hub"
+BINDING_EXPRESSION = re.compile(r"\{([\w.]+)\}")
+
+
+class Out:
+    """
+    Stand-in for the `func.Out` the Functions host passes to handlers.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, val) -> None:
+        self.value = val
+
+    def get(self):
+        return self.value
+
+
+class BindingProvider:
+    """
+    Supplies input binding values and consumes output binding values for one
+    binding type. `binding` is the binding's dict form from the decorator.
+    """
+
+    def resolve(self, binding: dict, req: func.HttpRequest):
+        raise NotImplementedError(f"No input support for {binding['type']}")
+
+    def write(self, binding: dict, value, req: func.HttpRequest) -> None:
+        raise NotImplementedError(f"No output support for {binding['type']}")
+
+
+def expand(template: str, req: func.HttpRequest) -> str:
+    """
+    Fill `{route_param}` and `{Query.name}` binding expressions.
+    """
+
+    def lookup(match):
+        name = match.group(1)
+        if name.startswith("Query."):
+            return req.params.get(name[len("Query.") :], "")
+        return req.route_params.get(name, "")
+
+    return BINDING_EXPRESSION.sub(lookup, template)
+
+
+class CosmosBindingProvider(BindingProvider):
+    def _container(self, binding: dict):
+        return get_container(
+            binding["connectionStringSetting"],
+            binding["databaseName"],
+            binding["containerName"],
+        )
+
+    def resolve(self, binding: dict, req: func.HttpRequest) -> func.DocumentList:
+        container = self._container(binding)
+        partition_key = expand(binding.get("partitionKey", ""), req) or None
+        if "id" in binding:
+            try:
+                items = [
+                    container.read_item(
+                        expand(binding["id"], req), partition_key=partition_key
+                    )
+                ]
+            except CosmosResourceNotFoundError:
+                items = []
+        elif partition_key is None:
+            items = container.query_items(
+                expand(binding["sqlQuery"], req), enable_cross_partition_query=True
+            )
+        else:
+            items = container.query_items(
+                expand(binding["sqlQuery"], req), partition_key=partition_key
+            )
+        return func.DocumentList(
+            [func.Document.from_dict(strip_system_properties(x)) for x in items]
+        )
+
+    def write(self, binding: dict, value, req: func.HttpRequest) -> None:
+        if isinstance(value, (str, bytes)):
+            value = json.loads(value)
+        container = self._container(binding)
+        for doc in value if isinstance(value, list) else [value]:
+            container.upsert_item(dict(doc))
+
+
+class LoggingSignalRProvider(BindingProvider):
+    """
+    Logs SignalR messages and group actions instead of delivering them.
+    """
+
+    def write(self, binding: dict, value, req: func.HttpRequest) -> None:
+        logging.info(f"signalR ({binding.get('hubName')}): {value}")
+
+
+class HubSignalRProvider(BindingProvider):
+    """
+    Delivers SignalR messages and group actions through the built-in hub.
+    """
+
+    def __init__(self, hub: BroadcastHub):
+        self.hub = hub
+
+    def write(self, binding: dict, value, req: func.HttpRequest) -> None:
+        self.hub.publish(value)
+
+
+def default_providers() -> Dict[str, BindingProvider]:
+    return {
+        "cosmosDB": CosmosBindingProvider(),
+        "signalR": LoggingSignalRProvider(),
+    }
+
+
+def iter_functions(module=function_app):
+    """
+    Build every function declared in a function app module.
+
+    FunctionApp.get_functions() may only be called once per process (the
+    Functions host does so), so the builders are built directly.
+    """
+    for value in vars(module).values():
+        if isinstance(value, FunctionBuilder):
+            yield value.build(module.app.auth_level)
+
+
+class Route:
+    __slots__ = ("name", "pattern", "methods", "bindings", "handler")
+
+    def __init__(self, function):
+        trigger = function.get_trigger()
+        self.name = function.get_function_name()
+        self.pattern = re.compile(
+            "^"
+            + re.sub(r"\\\{(\w+)\\\}", r"(?P<\1>[^/]+)", re.escape(trigger.route))
+            + "$"
+        )
+        self.methods = {str(getattr(m, "value", m)).upper() for m in trigger.methods}
+        self.bindings = [
+            b.get_dict_repr()
+            for b in function.get_bindings()
+            if b.type not in ("httpTrigger", "http")
+        ]
+        self.handler = function.get_user_function()
+
+
+class FunctionsASGIApp:
+    def __init__(
+        self,
+        functions=None,
+        providers: Optional[Dict[str, BindingProvider]] = None,
+        prefix: str = ROUTE_PREFIX,
+        max_threads: Optional[int] = None,
+        hub: Optional[BroadcastHub] = None,
+    ):
+        functions = iter_functions() if functions is None else functions
+        self.routes: List[Route] = [
+            Route(f) for f in functions if f.get_trigger().type == "httpTrigger"
+        ]
+        self.providers = default_providers()
+        self.providers.update(providers or {})
+        self.prefix = prefix.rstrip("/")
+        self.hub = hub
+        # Handlers and providers block on IO; run them off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+
+    def match(self, path: str):
+        if not path.startswith(self.prefix + "/"):
+            return None, None
+        path = path[len(self.prefix) + 1 :]
+        for route in self.routes:
+            found = route.pattern.match(path)
+            if found:
+                return route, found.groupdict()
+        return None, None
+
+    def invoke(self, route: Route, req: func.HttpRequest) -> func.HttpResponse:
+        kwargs = {}
+        outputs = []
+        for binding in route.bindings:
+            provider = self.providers[binding["type"]]
+            if binding["direction"] == BindingDirection.OUT:
+                kwargs[binding["name"]] = out = Out()
+                outputs.append((provider, binding, out))
+            else:
+                kwargs[binding["name"]] = provider.resolve(binding, req)
+
+        response = route.handler(req, **kwargs)
+
+        for provider, binding, out in outputs:
+            if out.value is not None:
+                provider.write(binding, out.value, req)
+        return response
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    self.executor.shutdown(wait=False)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if self.hub is not None and (
+            scope["path"] == HUB_PATH or scope["path"].startswith(HUB_PATH + "/")
+        ):
+            return await self.hub(scope, receive, send, scope["path"][len(HUB_PATH) :])
+        if scope["type"] != "http":
+            return
+
+        route, route_params = self.match(scope["path"])
+        if route is None:
+            return await self._send(send, _json_response({"error": "Not found"}, 404))
+        if scope["method"] not in route.methods:
+            return await self._send(
+                send, _json_response({"error": "Method not allowed"}, 405)
+            )
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        headers = {
+            k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]
+        }
+        query = scope.get("query_string", b"").decode("latin-1")
+        host = headers.get("host", "localhost")
+        req = func.HttpRequest(
+            method=scope["method"],
+            url=f"{scope.get('scheme', 'http')}://{host}{scope['path']}"
+            + (f"?{query}" if query else ""),
+            headers=headers,
+            params=dict(parse_qsl(query)),
+            route_params=route_params,
+            body=body,
+        )
+
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(
+                self.executor, self.invoke, route, req
+            )
+        except Exception as e:
+            logging.exception(f"Error invoking {route.name}")
+            response = _json_response({"error": str(e)}, 500)
+        await self._send(send, response)
+
+    async def _send(self, send, response: func.HttpResponse) -> None:
+        headers = [
+            (k.encode("latin-1"), v.encode("latin-1"))
+            for k, v in response.headers.items()
+        ]
+        if not any(k.lower() == b"content-type" for k, _ in headers):
+            content_type = response.mimetype or "text/plain"
+            if response.charset:
+                content_type += f"; charset={response.charset}"
+            headers.append((b"content-type", content_type.encode("latin-1")))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+        if not isinstance(response, StreamingHttpResponse):
+            await send(
+                {"type": "http.response.body", "body": response.get_body() or b""}
+            )
+            return
+        # Chunks are encoded (and may read documents) on the worker threads
+        loop = asyncio.get_running_loop()
+        chunks = response.iter_body()
+        while True:
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def _json_response(data: dict, status_code: int) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps(data), status_code=status_code, mimetype="application/json"
+    )
+
+
+def create_app(
+    providers: Optional[Dict[str, BindingProvider]] = None,
+    use_hub: Optional[bool] = None,
+) -> FunctionsASGIApp:
+    """
+    Build the app. With `use_hub` (by default, the `HUB_ENABLED` setting),
+    realtime messages go through the built-in hub served at /hub.
+    """
+    if use_hub is None:
+        use_hub = os.environ.get("HUB_ENABLED", "").lower() in ("1", "true")
+    hub = None
+    if use_hub:
+        hub = BroadcastHub()
+        providers = dict({"signalR": HubSignalRProvider(hub)}, **(providers or {}))
+        use_local_hub(HUB_PATH)
+    return FunctionsASGIApp(providers=providers, hub=hub)
+
+
+app = create_app()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve the API without the Functions host"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7071)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument(
+        "--hub", action="store_true", help="Serve the built-in hub at /hub"
+    )
+    args = parser.parse_args(argv)
+
+    hub = args.hub or app.hub is not None
+    if args.workers is None:
+        args.workers = 1 if hub else os.cpu_count() or 1
+    if hub and args.workers > 1:
+        # Hub connections and groups would be split across processes
+        raise SystemExit(
+            "The built-in hub needs a single worker; drop --workers or the hub"
+        )
+    if hub:
+        os.environ["HUB_ENABLED"] = "1"
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("Serving needs uvicorn: pip install uvicorn")
+
+    # Each worker process imports this module and builds its own app
+    uvicorn.run("asgi:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+Per-handler micro-benchmarks with regression thresholds.
+
+Each case calls a route function directly with a fake `HttpRequest` and
+`Out` outputs; the SDK reads the handlers make go to an in-memory
+container. Cases run for each plan size and record the
+median latency and the peak bytes allocated by one invocation.
+
+    python bench.py                 compare with bench_baseline.json
+    python bench.py --update        record a new baseline
+    python bench.py -k vote --sizes small,medium
+
+Exits 1 when a case's latency grows by more than `--threshold` (default
+25%) or its allocations by more than `--alloc-threshold` (default 10%).
+Latency baselines are machine specific; record them where they are checked.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import azure.functions as func
+
+import drafts
+import function_app
+import ranking
+import storage
+import text_ops
+import user_index
+from asgi import Out, iter_functions
+from event_log import op_doc, snapshot_docs
+from models import ActivityDoc, DateDoc, PlanDoc
+from ranking import empty_ranking, set_votes
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+
+# (dates, activities per date)
+SIZES = {"small": (10, 5), "medium": (60, 20), "large": (365, 50)}
+
+PLAN_ID = "bench-plan"
+USER = "bench-user"
+CREATED_AT = 1717000000000
+WARMUP = 3
+
+
+class FakeContainer:
+    """
+    In-memory container answering the reads and writes the handlers make.
+    """
+
+    def __init__(self, items=()):
+        self.items = {item["id"]: item for item in items}
+
+    def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise storage.CosmosResourceNotFoundError()
+        # The SDK parses a fresh copy on every read
+        return dict(json.loads(json.dumps(self.items[item])), _etag='"0"')
+
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        items = self.items.values()
+        types = re.search(r"c\.type IN \(([^)]*)\)|c\.type ?= ?('\w+')", query)
+        if types:
+            items = [x for x in items if f"'{x['type']}'" in "".join(types.groups(""))]
+        if parameters and parameters[0]["name"] == "@prefix":
+            items = [x for x in items if x["id"].startswith(parameters[0]["value"])]
+        if "VALUE c.id" in query:
+            return iter([x["id"] for x in items])
+        return iter(json.loads(json.dumps(list(items))))
+
+    def upsert_item(self, body):
+        self.items[body["id"]] = body
+
+    def patch_item(self, item, partition_key, patch_operations):
+        pass
+
+    # Conditional writes are dropped like binding output, so every call
+    # makes the same change
+    def replace_item(self, item, body, **kwargs):
+        pass
+
+    def create_item(self, body):
+        pass
+
+    def execute_item_batch(self, batch_operations, partition_key):
+        pass
+
+
+def _dates(n_dates: int):
+    return [str(date(2024, 1, 1) + timedelta(days=d)) for d in range(n_dates)]
+
+
+def _plan_docs(n_dates: int, per_date: int):
+    docs = [PlanDoc(PLAN_ID, "Bench", USER, CREATED_AT).to_doc()]
+    for day in _dates(n_dates):
+        docs.append(DateDoc(PLAN_ID, day, USER, CREATED_AT).to_doc())
+        for i in range(per_date):
+            activity = ActivityDoc(
+                PLAN_ID, day, i, USER, CREATED_AT, activity_text="Hike the ridge"
+            )
+            activity.set_fields(upVoters=[USER] if i % 2 else [], downVoters=[])
+            docs.append(activity.to_doc())
+    return docs
+
+
+def _ranking(n_dates: int, per_date: int):
+    doc = empty_ranking(PLAN_ID)
+    for day in _dates(n_dates):
+        for i in range(per_date):
+            set_votes(doc, day, str(i), [USER] * (i % 3), [])
+    return doc
+
+
+def _plan_container(n_dates: int, per_date: int) -> FakeContainer:
+    return FakeContainer([*_plan_docs(n_dates, per_date), _ranking(n_dates, per_date)])
+
+
+def _use(container: FakeContainer) -> None:
+    storage.get_container = lambda *args: container
+    function_app.get_container = storage.get_container
+    ranking.get_container = storage.get_container
+    text_ops.get_container = storage.get_container
+
+
+def _request(method, body=None, headers=None, **route_params):
+    return func.HttpRequest(
+        method,
+        "/api/bench",
+        body=json.dumps(body).encode() if body is not None else b"",
+        headers=headers,
+        route_params=route_params,
+    )
+
+
+# Cases: build(n_dates, per_date) -> (function name, setup) where setup()
+# returns the request and bindings for one call, made outside the timing
+
+
+def case_get_plan(n_dates, per_date, headers=None):
+    docs = {x["id"]: x for x in _plan_docs(n_dates, per_date)}
+    snapshot = snapshot_docs(PLAN_ID, docs, "op|0")
+    ops = [
+        op_doc(PLAN_ID, "activityVoted", USER, updates={doc_id: {"upVoters": []}})
+        for doc_id in list(docs)[1:11]
+    ]
+    container = FakeContainer([*snapshot, *ops])
+
+    def setup():
+        _use(container)
+        return _request("GET", headers=headers, plan_id=PLAN_ID), {"deleteOps": Out()}
+
+    return "get_plan", setup
+
+
+def case_get_plan_gzip(n_dates, per_date):
+    return case_get_plan(n_dates, per_date, {"Accept-Encoding": "gzip"})
+
+
+def case_create_plan(n_dates, per_date):
+    body = {
+        "uuid": PLAN_ID,
+        "planName": "Bench",
+        "createdBy": USER,
+        "dates": [{"id": x} for x in _dates(n_dates)],
+    }
+
+    def setup():
+        return _request("POST", body), {
+            "outputDocPlan": Out(),
+            "outputDoc": Out(),
+            "opLog": Out(),
+            "signalR": Out(),
+        }
+
+    return "create_plan", setup
+
+
+def case_delete_date(n_dates, per_date):
+    container = _plan_container(n_dates, per_date)
+    day = _dates(n_dates)[0]
+
+    def setup():
+        _use(container)
+        return _request("DELETE", plan_id=PLAN_ID, date_id=day, user_name=USER), {
+            "signalR": Out(),
+            "deleteDoc": Out(),
+            "opLog": Out(),
+        }
+
+    return "delete_date", setup
+
+
+def case_update_activity(n_dates, per_date):
+    dates = _dates(n_dates)
+    container = _plan_container(n_dates, per_date)
+    body = {"activityText": "Hike the ridge", "updatedBy": USER, "isFinal": True}
+
+    def setup():
+        _use(container)
+        return _request(
+            "PATCH", body, plan_id=PLAN_ID, date_id=dates[0], activity_id="1"
+        ), {
+            "signalR": Out(),
+            "updateDoc": Out(),
+            "deleteDoc": Out(),
+            "opLog": Out(),
+        }
+
+    return "update_activity", setup
+
+
+def case_vote_activity(n_dates, per_date):
+    day = _dates(n_dates)[0]
+    container = _plan_container(n_dates, per_date)
+    voters = [f"user{i}" for i in range(10)]
+    body = {"upVoters": voters, "downVoters": [], "voter": USER}
+
+    def setup():
+        _use(container)
+        return _request("PATCH", body, plan_id=PLAN_ID, date_id=day, activity_id="0"), {
+            "signalR": Out(),
+            "updateDoc": Out(),
+            "opLog": Out(),
+        }
+
+    return "vote_activity", setup
+
+
+CASES = [
+    case_get_plan,
+    case_get_plan_gzip,
+    case_create_plan,
+    case_delete_date,
+    case_update_activity,
+    case_vote_activity,
+]
+
+
+def run_case(handler, setup, iterations: int) -> dict:
+    timings = []
+    # Handlers may print; keep that off the terminal but in the timings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(iterations + WARMUP):
+            req, bindings = setup()
+            start = time.perf_counter()
+            response = handler(req, **bindings)
+            # Bodies may be encoded lazily, as the host reads them
+            response.get_body()
+            if i >= WARMUP:
+                timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise RuntimeError(f"{response.status_code}: {response.get_body()}")
+
+        req, bindings = setup()
+        tracemalloc.start()
+        handler(req, **bindings).get_body()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        "medianMs": round(statistics.median(timings) * 1000, 4),
+        "peakBytes": peak,
+    }
+
+
+def _isolate() -> None:
+    """
+    Keep the handlers' side effects in memory and quiet.
+    """
+    container = FakeContainer()
+    storage.get_container = lambda *args: container
+    user_index.get_container = lambda *args: container
+    drafts.draft_buffer.container = container
+    logging.disable(logging.CRITICAL)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Handler micro-benchmarks")
+    parser.add_argument("--update", action="store_true", help="Record a baseline")
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("-k", dest="filter", default="", help="Only matching cases")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--alloc-threshold", type=float, default=0.10)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args(argv)
+
+    _isolate()
+    handlers = {
+        f.get_function_name(): f.get_user_function()
+        for f in iter_functions(function_app)
+    }
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    for size in args.sizes.split(","):
+        n_dates, per_date = SIZES[size]
+        for case in CASES:
+            name, setup = case(n_dates, per_date)
+            key = f"{case.__name__[5:]}[{size}]"
+            if args.filter not in key:
+                continue
+            result = results[key] = run_case(handlers[name], setup, args.iterations)
+
+            line = (
+                f"{key:<28} {result['medianMs']:>10.3f} ms {result['peakBytes']:>12,} B"
+            )
+            old = baseline.get(key)
+            if old and not args.update:
+                latency = result["medianMs"] / old["medianMs"] - 1
+                alloc = result["peakBytes"] / old["peakBytes"] - 1
+                line += f"   {latency:+7.1%} {alloc:+7.1%}"
+                if latency > args.threshold or alloc > args.alloc_threshold:
+                    regressions.append(key)
+                    line += "  REGRESSED"
+            print(line)
+
+    if args.update:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"Regressed: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+SIGNALR_HUB_NAME = "chatHub"
+SIGNALR_CONN_STRING = "AzureSignalRConnectionString"
+COSMOS_DB_NAME = "TravelPlanner"
+COSMOS_CONTAINER_NAME = "Plans"
+COSMOS_CONN_STRING = "CosmosDB"
@@ -0,0 +1,188 @@
+"""
+Write-behind buffer for non-final activity edits.
+
+Non-final `update_activity` calls only keep the latest text per activity in
+memory; a background thread flushes whatever changed every
+`DRAFT_FLUSH_INTERVAL_SECONDS` (app setting, default 5) as one transactional
+batch per plan, so a burst of keystrokes costs one write. The flush sets the
+activity's `draft` field ({"text", "by", "at"}, `at` being when the edit was
+made) and logs the same change as an op. A draft only matters while
+`draft.at` is newer than the activity's `textUpdatedAt`, which only final
+text updates set (votes move `lastUpdatedAt` as well); the final update
+clears it and drops any buffered draft, and the patch is conditional on
+`textUpdatedAt`, so a flush racing a final update on another instance
+can't bring back an older text.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from event_log import op_doc
+from storage import get_container
+
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("DRAFT_FLUSH_INTERVAL_SECONDS", 5))
+
+# Transactional batches are limited to 100 operations, two per draft
+MAX_DRAFTS_PER_BATCH = 50
+
+
+class Draft:
+    __slots__ = ("text", "by", "at", "first_at", "updated_at", "edits")
+
+    def __init__(self, text: str, by: str, at: int, now: float):
+        self.text = text
+        self.by = by
+        # Wall-clock time of the edit in ms, for comparing with textUpdatedAt
+        self.at = at
+        self.first_at = now
+        self.updated_at = now
+        self.edits = 1
+
+
+class DraftBuffer:
+    """
+    Latest unsaved text per (plan id, activity id), flushed on a timer.
+    """
+
+    def __init__(self, interval: float = FLUSH_INTERVAL_SECONDS, container=None):
+        self.interval = interval
+        self.container = container
+        self.drafts: Dict[Tuple[str, str], Draft] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.edits = 0
+        self.writes = 0
+        self.discarded = 0
+        self.flush_latencies = deque(maxlen=1000)
+
+    def put(self, plan_id: str, activity_id: str, text: str, by: str) -> None:
+        now = time.monotonic()
+        at = int(time.time() * 1000)
+        with self.lock:
+            self.edits += 1
+            draft = self.drafts.get((plan_id, activity_id))
+            if draft is None:
+                self.drafts[(plan_id, activity_id)] = Draft(text, by, at, now)
+            else:
+                draft.text, draft.by, draft.at, draft.updated_at = text, by, at, now
+                draft.edits += 1
+        self._ensure_started()
+
+    def discard(self, plan_id: str, activity_id: str) -> Optional[Draft]:
+        """
+        Drop a buffered draft, e.g. because the final text is being written.
+        """
+        with self.lock:
+            draft = self.drafts.pop((plan_id, activity_id), None)
+            if draft is not None:
+                self.discarded += 1
+            return draft
+
+    def flush(self) -> int:
+        """
+        Write every buffered draft; returns the number of writes made.
+        """
+        with self.lock:
+            drafts, self.drafts = self.drafts, {}
+        if not drafts:
+            return 0
+
+        by_plan = {}
+        for (plan_id, activity_id), draft in drafts.items():
+            by_plan.setdefault(plan_id, []).append((activity_id, draft))
+
+        container = self.container or get_container()
+        writes = 0
+        for plan_id, items in by_plan.items():
+            for i in range(0, len(items), MAX_DRAFTS_PER_BATCH):
+                writes += self._write(
+                    container, plan_id, items[i : i + MAX_DRAFTS_PER_BATCH]
+                )
+
+        now = time.monotonic()
+        with self.lock:
+            self.writes += writes
+            self.flush_latencies.extend(now - d.first_at for d in drafts.values())
+        logging.info(
+            f"Flushed {len(drafts)} drafts in {writes} writes: {self.metrics()}"
+        )
+        return writes
+
+    def _write(self, container, plan_id: str, items) -> int:
+        operations = []
+        for activity_id, draft in items:
+            value = {"text": draft.text, "by": draft.by, "at": draft.at}
+            operations.append(
+                (
+                    "patch",
+                    (activity_id, [{"op": "set", "path": "/draft", "value": value}]),
+                    {
+                        "filter_predicate": "FROM c WHERE NOT IS_DEFINED("
+                        f"c.textUpdatedAt) OR c.textUpdatedAt < {draft.at}"
+                    },
+                )
+            )
+            operations.append(
+                (
+                    "create",
+                    (
+                        op_doc(
+                            plan_id,
+                            "activityDrafted",
+                            draft.by,
+                            updates={activity_id: {"draft": value}},
+                        ),
+                    ),
+                )
+            )
+        try:
+            container.execute_item_batch(operations, partition_key=plan_id)
+            return 1
+        except Exception:
+            if len(items) == 1:
+                # Most likely the activity was deleted or finalized meanwhile
+                logging.warning(f"Dropped draft of {items[0][0]} in plan {plan_id}")
+                return 1
+            # One bad activity fails the whole batch; retry them one by one
+            return sum(self._write(container, plan_id, [item]) for item in items)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.flush_latencies)
+            return {
+                "edits": self.edits,
+                "writes": self.writes,
+                "discarded": self.discarded,
+                "pending": len(self.drafts),
+                "writeSavings": (
+                    round(1 - self.writes / self.edits, 4) if self.edits else 0
+                ),
+                "flushLatencyP50": (
+                    round(latencies[len(latencies) // 2], 3) if latencies else None
+                ),
+                "flushLatencyMax": round(latencies[-1], 3) if latencies else None,
+            }
+
+    def _ensure_started(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="draft-flusher", daemon=True
+                )
+                self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Error flushing drafts")
+
+
+draft_buffer = DraftBuffer()
@@ -0,0 +1,173 @@
+"""
+Per-plan operation log with snapshot compaction.
+
+Every mutating route appends one `op` document to the plan's partition:
+
+    {"plan": ..., "id": "op|<ms>|<rand>", "type": "op", "kind": "activityUpdated",
+     "by": "user", "at": <ms>, "put": [docs], "set": {id: {fields}}, "del": [ids]}
+
+The plan state is the snapshot plus every op after its `upTo` id, so
+`get_plan` needs one query however many documents the plan has. A snapshot
+is split across `snapshot|<at>|<n>` documents of at most
+`SNAPSHOT_CHUNK_BYTES` each, since Cosmos items are capped at 2 MB; readers
+use the newest complete set.
+
+Compaction happens when `get_plan` rebuilds the whole plan and finds
+`SNAPSHOT_EVERY` ops in the tail, and nightly in the `compact_plans` timer
+function for every plan with that many ops, so plans that are written but
+not read stay bounded too. Op ids carry the writer's clock and an op can
+land after ops with later ids, so only ops older than `SNAPSHOT_SAFETY_MS`
+are folded; younger ones stay in the tail.
+"""
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SNAPSHOT_ID = "snapshot"
+SNAPSHOT_EVERY = 50
+# Encoded documents per snapshot chunk, well below the 2 MB item limit
+SNAPSHOT_CHUNK_BYTES = 1_000_000
+SNAPSHOT_SAFETY_MS = 5 * 60 * 1000
+
+# Kind of the op written by create_plan; a log starting with it is complete
+PLAN_CREATED = "planCreated"
+
+
+def op_doc(
+    plan_id: str,
+    kind: str,
+    by: Optional[str],
+    put: Optional[List[dict]] = None,
+    updates: Optional[Dict[str, dict]] = None,
+    deleted: Optional[List[str]] = None,
+) -> dict:
+    """
+    Build an op document; empty sections are left out to keep it compact.
+    """
+    current_time = int(time.time() * 1000)
+    doc = {
+        "plan": plan_id,
+        # Sortable by time; the suffix keeps concurrent ops apart
+        "id": f"op|{current_time:013d}|{os.urandom(3).hex()}",
+        "type": "op",
+        "kind": kind,
+        "by": by,
+        "at": current_time,
+    }
+    if put:
+        doc["put"] = put
+    if updates:
+        doc["set"] = updates
+    if deleted:
+        doc["del"] = deleted
+    return doc
+
+
+def apply_ops(docs: Dict[str, dict], ops: Iterable[dict]) -> Dict[str, dict]:
+    """
+    Apply ops in id order to a {document id: document} map, in place.
+    """
+    for op in sorted(ops, key=lambda x: x["id"]):
+        for doc in op.get("put", ()):
+            docs[doc["id"]] = dict(doc)
+        for doc_id, fields in op.get("set", {}).items():
+            if doc_id in docs:
+                docs[doc_id].update(fields)
+        for doc_id in op.get("del", ()):
+            docs.pop(doc_id, None)
+    return docs
+
+
+def tail_ops(snapshot: Optional[dict], ops: Iterable[dict]) -> List[dict]:
+    """
+    Get the ops not yet folded into the snapshot (compacted ops may linger
+    until their ttl expires).
+    """
+    up_to = snapshot["upTo"] if snapshot else ""
+    return sorted((op for op in ops if op["id"] > up_to), key=lambda x: x["id"])
+
+
+def is_complete_log(ops: List[dict]) -> bool:
+    """
+    Whether the ops alone rebuild the plan (it was created with the log on).
+    """
+    return bool(ops) and ops[0].get("kind") == PLAN_CREATED
+
+
+def fold_boundary(now: Optional[int] = None) -> str:
+    """
+    The `upTo` of a snapshot taken now: ops with smaller ids are old enough
+    to fold.
+    """
+    if now is None:
+        now = int(time.time() * 1000)
+    return f"op|{now - SNAPSHOT_SAFETY_MS:013d}"
+
+
+def snapshot_docs(plan_id: str, docs: Dict[str, dict], up_to: str) -> List[dict]:
+    """
+    Split a snapshot of `docs` into chunk documents.
+    """
+    at = int(time.time() * 1000)
+    parts: List[Dict[str, dict]] = [{}]
+    size = 0
+    for doc_id, doc in docs.items():
+        doc_size = len(json.dumps(doc))
+        if parts[-1] and size + doc_size > SNAPSHOT_CHUNK_BYTES:
+            parts.append({})
+            size = 0
+        parts[-1][doc_id] = doc
+        size += doc_size
+    return [
+        {
+            "plan": plan_id,
+            "id": f"{SNAPSHOT_ID}|{at:013d}|{i}",
+            "type": "snapshot",
+            "upTo": up_to,
+            "at": at,
+            "part": i,
+            "parts": len(parts),
+            "docs": part,
+        }
+        for i, part in enumerate(parts)
+    ]
+
+
+def load_snapshot(chunks: Iterable[dict]) -> Tuple[Optional[dict], List[dict]]:
+    """
+    Join the newest complete snapshot from its chunk documents; returns it
+    (`upTo`, `at`, `docs`) with the chunks of older snapshots, and of
+    unfinished ones past the safety window, which can be expired.
+    """
+    generations: Dict[tuple, List[dict]] = {}
+    for chunk in chunks:
+        # Single-document snapshots from before chunking have no parts
+        generations.setdefault((chunk["upTo"], chunk["at"]), []).append(chunk)
+    complete = [
+        key
+        for key, parts in generations.items()
+        if len(parts) == parts[0].get("parts", 1)
+    ]
+    if not complete:
+        return None, []
+    newest = max(complete)
+    docs: Dict[str, dict] = {}
+    for chunk in generations.pop(newest):
+        docs.update(chunk["docs"])
+    now = int(time.time() * 1000)
+    stale = [
+        chunk
+        for key, parts in generations.items()
+        if key < newest or key[1] < now - SNAPSHOT_SAFETY_MS
+        for chunk in parts
+    ]
+    snapshot = {"upTo": newest[0], "at": newest[1], "docs": docs}
+    return snapshot, stale
+
+
+def expired(ops: Iterable[dict]) -> List[dict]:
+    """
+    Mark compacted ops for deletion.
+    """
+    return [dict(op, ttl=1) for op in ops]
@@ -1,16 +1,101 @@
+import itertools
 import json
 import logging
-from datetime import datetime, timezone
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
 import azure.functions as func
 
+from archive import (
+    ARCHIVE_DIR,
+    ArchiveUnavailableError,
+    archive_inactive_plans,
+    rehydrate,
+)
+from constants import (
+    COSMOS_CONN_STRING,
+    COSMOS_CONTAINER_NAME,
+    COSMOS_DB_NAME,
+    SIGNALR_CONN_STRING,
+    SIGNALR_HUB_NAME,
+)
+from drafts import draft_buffer
+from event_log import (
+    PLAN_CREATED,
+    SNAPSHOT_EVERY,
+    apply_ops,
+    expired,
+    fold_boundary,
+    is_complete_log,
+    load_snapshot,
+    op_doc,
+    snapshot_docs,
+    tail_ops,
+)
+from idempotency import idempotent
+from models import (
+    ActivityDoc,
+    DateDoc,
+    PlanDoc,
+    activity_doc_id,
+    activity_prefix,
+    activity_sort_key,
+    date_doc_id,
+    parse_activity_id,
+    parse_date_id,
+)
+from plan_index import plan_ids
+from plan_io import import_documents, iter_ndjson, iter_plan_documents
+from profiling import profiled
+from ranking import (
+    load_ranking,
+    move,
+    ranking_message,
+    remove,
+    set_votes,
+    update_ranking,
+)
+from storage import (
+    get_container,
+    query_documents,
+    query_page,
+    query_plan_documents,
+    read_document,
+)
+from signalr_tokens import connection_info
+from streaming import StreamingHttpResponse, chunked, data_response
+from text_ops import (
+    StaleRevisionError,
+    forget_text_state,
+    get_text_state,
+    validate_ops,
+)
+from user_index import forget_plan, list_user_plans, touch_user_plan
+
 # Initialize function app
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-SIGNALR_HUB_NAME = "chatHub"
-SIGNALR_CONN_STRING = "AzureSignalRConnectionString"
-COSMOS_DB_NAME = "TravelPlanner"
-COSMOS_CONTAINER_NAME = "Plans"
-COSMOS_CONN_STRING = "CosmosDB"
+MAX_WINDOW_PAGE_SIZE = 1000
+MAX_PLANS_PER_REQUEST = 50
+# Shared by all getPlans requests on the instance, bounding reads in flight
+plan_reader = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("GET_PLANS_CONCURRENCY", 8)),
+    thread_name_prefix="getPlans",
+)
+DATE_ACTIVITIES_QUERY = (
+    "SELECT * FROM c WHERE c.type='activity' AND STARTSWITH(c.id, @prefix) "
+    "AND (NOT IS_DEFINED(c.ttl) OR c.ttl != 1)"
+)
+WINDOW_QUERY = (
+    "SELECT * FROM c WHERE c.type IN ('date', 'activity') "
+    "AND c.id >= @from AND c.id <= @to "
+    "AND (NOT IS_DEFINED(c.ttl) OR c.ttl != 1) ORDER BY c.id"
+)
+# Plans with logged ops, and how many ops one has, for compact_plans
+LOGGED_PLANS_QUERY = "SELECT DISTINCT VALUE c.plan FROM c WHERE c.type = 'op'"
+OP_COUNT_QUERY = "SELECT VALUE COUNT(1) FROM c WHERE c.type = 'op'"
+MAX_COMPACTIONS_PER_RUN = int(os.environ.get("COMPACT_MAX_PLANS", 500))
 
 
 @app.route(
@@ -18,19 +103,18 @@ COSMOS_CONN_STRING = "CosmosDB"
     auth_level=func.AuthLevel.ANONYMOUS,
     methods=["GET", "POST", "OPTIONS"],
 )
-@app.generic_input_binding(
-    arg_name="connectionInfo",
-    type="signalRConnectionInfo",
-    hubName=SIGNALR_HUB_NAME,
-    connectionStringSetting=SIGNALR_CONN_STRING,
-)
-def negotiate(req: func.HttpRequest, connectionInfo: str) -> func.HttpResponse:
+@profiled
+def negotiate(req: func.HttpRequest) -> func.HttpResponse:
     """
-    Handle SignalR negotiate requests.
+    Handle SignalR negotiate requests. The access token is minted here (see
+    signalr_tokens.py) rather than fetched through a binding; it is bound to
+    the `x-ms-signalr-userid` header or `userId` parameter when given.
     """
     try:
         logging.info("Within negotiate; returning connection info")
-        return func.HttpResponse(connectionInfo)
+        return func.HttpResponse(
+            json.dumps(connection_info(req)), mimetype="application/json"
+        )
 
     except Exception as e:
         logging.exception("Error in negotiate")
@@ -39,26 +123,75 @@ def negotiate(req: func.HttpRequest, connectionInfo: str) -> func.HttpResponse:
         )
 
 
+@app.timer_trigger(schedule="0 0 3 * * *", arg_name="timer", run_on_startup=False)
+def archive_plans(timer: func.TimerRequest) -> None:
+    """
+    Move plans untouched for `ARCHIVE_AFTER_DAYS` to cold storage, nightly
+    (see archive.py).
+    """
+    if not ARCHIVE_DIR:
+        logging.info("Archiving is off: ARCHIVE_DIR is not set")
+        return
+    if timer.past_due:
+        logging.info("archive_plans is running late")
+    summary = archive_inactive_plans()
+    logging.info(f"Archived inactive plans: {summary}")
+
+
+@app.timer_trigger(schedule="0 30 2 * * *", arg_name="timer", run_on_startup=False)
+@app.generic_output_binding(
+    arg_name="deleteOps",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+)
+def compact_plans(timer: func.TimerRequest, deleteOps: func.Out[func.Document]) -> None:
+    """
+    Compact the op logs of plans with `SNAPSHOT_EVERY` or more ops, nightly,
+    so plans that are written but seldom read in full stay bounded too;
+    getPlan compacts the plans it reads.
+    """
+    if timer.past_due:
+        logging.info("compact_plans is running late")
+    container = get_container()
+    logged = container.query_items(
+        LOGGED_PLANS_QUERY, enable_cross_partition_query=True
+    )
+    compacted = 0
+    expire = []
+    for plan_id in logged:
+        if compacted >= MAX_COMPACTIONS_PER_RUN:
+            break
+        try:
+            counts = container.query_items(OP_COUNT_QUERY, partition_key=plan_id)
+            if next(iter(counts), 0) < SNAPSHOT_EVERY:
+                continue
+            # Archived plans have no ops, so nothing is rehydrated here
+            _, _, compaction = rebuild_plan(plan_id, rehydrate_archived=False)
+            if compaction:
+                expire += write_compaction(plan_id, compaction)
+                compacted += 1
+        except Exception:
+            logging.exception(f"Failed to compact plan {plan_id}")
+    if expire:
+        deleteOps.set([func.Document.from_dict(x) for x in expire])
+    logging.info(f"Compacted the op logs of {compacted} plans")
+
+
 @app.route(
     route="registerUser",
     auth_level=func.AuthLevel.ANONYMOUS,
     methods=["GET", "POST", "OPTIONS"],
 )
-@app.generic_input_binding(
-    arg_name="connectionInfo",
-    type="signalRConnectionInfo",
-    hubName=SIGNALR_HUB_NAME,
-    connectionStringSetting=SIGNALR_CONN_STRING,
-)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
-def register_user(
-    req: func.HttpRequest, connectionInfo: str, signalR: func.Out[str]
-) -> func.HttpResponse:
+@profiled
+def register_user(req: func.HttpRequest, signalR: func.Out[str]) -> func.HttpResponse:
     """
     Handle SignalR user group registration.
     """
@@ -67,6 +200,7 @@ def register_user(
 
         plan_id = req.params.get("planId")
         connectionId = req.params.get("connectionId")
+        user_name = req.params.get("userName")
         required_fields = {"plan_id": plan_id, "connectionId": connectionId}
         missing_fields = [x for x, y in required_fields.items() if not y]
         if missing_fields:
@@ -84,6 +218,7 @@ def register_user(
         action = {"connectionId": connectionId, "groupName": plan_id, "action": "add"}
         signalR.set(json.dumps(action))
         logging.info(f"Added connection '{connectionId}' to group '{plan_id}'")
+        touch_user_plan(user_name, plan_id)
         return func.HttpResponse(status_code=200)
 
     except Exception as e:
@@ -108,16 +243,26 @@ def register_user(
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
 )
+@app.generic_output_binding(
+    arg_name="opLog",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def create_plan(
     req: func.HttpRequest,
     outputDocPlan: func.Out[str],
     outputDoc: func.Out[str],
+    opLog: func.Out[str],
     signalR: func.Out[str],
 ) -> func.HttpResponse:
     """
@@ -154,16 +299,7 @@ def create_plan(
         plan_name = plan_data["planName"]
         created_by = plan_data["createdBy"]
         current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
-        document = {
-            "plan": plan_id,
-            "id": plan_id,
-            "type": "plan",
-            "planName": plan_name,
-            "createdBy": created_by,
-            "createdAt": current_time,
-            "lastUpdatedBy": created_by,
-            "lastUpdatedAt": current_time,
-        }
+        document = PlanDoc(plan_id, plan_name, created_by, current_time).to_doc()
 
         docs = {"plan": document}
         docs.update(
@@ -177,6 +313,20 @@ def create_plan(
 
         logging.info(f"Attempting to save document to CosmosDB: {document}")
         outputDocPlan.set(json.dumps(document))
+        opLog.set(
+            json.dumps(
+                op_doc(
+                    plan_id,
+                    PLAN_CREATED,
+                    created_by,
+                    put=[document, *docs["dates"], *docs["activities"]],
+                )
+            )
+        )
+        plan_ids.seed(
+            plan_id, [doc["id"] for doc in (*docs["dates"], *docs["activities"])]
+        )
+        touch_user_plan(created_by, plan_id, role="owner", plan_name=plan_name)
 
         # Format for frontend
         infoDoc = {
@@ -186,7 +336,11 @@ def create_plan(
                 "createdBy": created_by,
             },
             "dates": [
-                {"id": date["id"].split("|")[1] + "T00:00:00.000Z", "createdBy": created_by, "activities": []}
+                {
+                    "id": parse_date_id(date["id"]) + "T00:00:00.000Z",
+                    "createdBy": created_by,
+                    "activities": [],
+                }
                 for date in docs["dates"]
             ],
         }
@@ -210,69 +364,224 @@ def create_plan(
 
 
 @app.route(
-    route="getPlan/{plan_id}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"]
-)
-@app.generic_input_binding(
-    arg_name="planDoc",
-    type="cosmosDB",
-    connection_string_setting=COSMOS_CONN_STRING,
-    database_name=COSMOS_DB_NAME,
-    container_name=COSMOS_CONTAINER_NAME,
-    id="{plan_id}",
-    partitionKey="{plan_id}",
+    route="clonePlan/{plan_id}", auth_level=func.AuthLevel.ANONYMOUS, methods=["POST"]
 )
-@app.generic_input_binding(
-    arg_name="datesDocs",
-    type="cosmosDB",
-    connection_string_setting=COSMOS_CONN_STRING,
-    database_name=COSMOS_DB_NAME,
-    container_name=COSMOS_CONTAINER_NAME,
-    sql_query="SELECT * FROM c WHERE c.type='date'",
-    partitionKey="{plan_id}",
+@profiled
+@idempotent
+def clone_plan(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Copy a plan's dates and activities into a new plan, optionally shifted by
+    `dateOffset` days (or so the first date lands on `startDate`). Activity
+    text is copied; votes, revisions and drafts start afresh.
+
+    The copy is written server-side in transactional batches of up to 100
+    documents, then a snapshot of it (in chunks, see event_log.py), and the
+    new plan document last, so the plan only appears once everything else
+    is written and a failed clone can be retried with the same `uuid`.
+    """
+    try:
+        logging.info("Starting clone_plan function")
+
+        source_id = req.route_params.get("plan_id")
+        clone_data = req.get_json()
+
+        required_fields = {
+            "uuid": clone_data.get("uuid"),
+            "createdBy": clone_data.get("createdBy"),
+        }
+        missing_fields = [x for x, y in required_fields.items() if not y]
+        if missing_fields:
+            return func.HttpResponse(
+                json.dumps(
+                    {
+                        "error": "Missing required fields from JSON",
+                        "missing": missing_fields,
+                    }
+                ),
+                status_code=400,
+                mimetype="application/json",
+            )
+
+        plan_id = f"{required_fields['uuid']}"
+        created_by = required_fields["createdBy"]
+        if read_document(plan_id, plan_id):
+            return func.HttpResponse(
+                json.dumps({"error": f"Plan {plan_id} already exists"}),
+                status_code=409,
+                mimetype="application/json",
+            )
+
+        docs, _, _ = rebuild_plan(source_id)
+        sourceDoc = docs.get(source_id)
+        if not sourceDoc:
+            return func.HttpResponse(
+                json.dumps({"error": "Plan not found"}),
+                status_code=404,
+                mimetype="application/json",
+            )
+        date_ids, activity_ids = sorted_plan_ids(docs)
+
+        def shifted(day: str) -> str:
+            return str(date.fromisoformat(day) + timedelta(days=offset))
+
+        try:
+            offset = int(clone_data.get("dateOffset") or 0)
+            if clone_data.get("startDate") and date_ids:
+                offset = (
+                    date.fromisoformat(clone_data["startDate"])
+                    - date.fromisoformat(parse_date_id(date_ids[0]))
+                ).days
+            if date_ids:
+                # Fail here rather than halfway through the copy
+                shifted(parse_date_id(date_ids[0]))
+                shifted(parse_date_id(date_ids[-1]))
+        except (TypeError, ValueError, OverflowError) as e:
+            return func.HttpResponse(
+                json.dumps({"error": f"Invalid dateOffset or startDate: {e}"}),
+                status_code=400,
+                mimetype="application/json",
+            )
+
+        current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
+        plan_name = clone_data.get("planName") or sourceDoc.get("planName")
+        document = PlanDoc(plan_id, plan_name, created_by, current_time).to_doc()
+        copies = [
+            DateDoc(
+                plan_id, shifted(parse_date_id(x)), created_by, current_time
+            ).to_doc()
+            for x in date_ids
+        ]
+        for x in activity_ids:
+            day, index = parse_activity_id(x)
+            activity = ActivityDoc(
+                plan_id,
+                shifted(day),
+                index,
+                created_by,
+                current_time,
+                activity_text=docs[x].get("activityText", ""),
+            )
+            activity.set_fields(upVoters=[], downVoters=[])
+            copies.append(activity.to_doc())
+
+        container = get_container()
+        stats = import_documents(container, copies)
+        if stats["failed"]:
+            return func.HttpResponse(
+                json.dumps(
+                    {
+                        "error": f"Failed to copy {stats['failed']} of "
+                        f"{len(copies)} documents; retry to finish the clone"
+                    }
+                ),
+                status_code=500,
+                mimetype="application/json",
+            )
+        # A whole-plan snapshot can exceed a batch's 2 MB, so its chunks go
+        # one by one
+        snapshot = snapshot_docs(
+            plan_id, {doc["id"]: doc for doc in (document, *copies)}, ""
+        )
+        for chunk in snapshot:
+            container.upsert_item(chunk)
+        container.upsert_item(document)
+        logging.info(
+            f"Cloned plan {source_id} into {plan_id}: {len(copies)} documents "
+            f"in {stats['batches']} batches and {len(snapshot)} snapshot chunks, "
+            f"{stats['seconds']} s"
+        )
+
+        plan_ids.seed(plan_id, [doc["id"] for doc in copies])
+        touch_user_plan(created_by, plan_id, role="owner", plan_name=plan_name)
+
+        return func.HttpResponse(
+            json.dumps(
+                {
+                    "status": "success",
+                    "data": {
+                        "planId": plan_id,
+                        "planName": plan_name,
+                        "clonedFrom": source_id,
+                        "dateOffset": offset,
+                        "dates": len(date_ids),
+                        "activities": len(activity_ids),
+                    },
+                }
+            ),
+            mimetype="application/json",
+        )
+    except ArchiveUnavailableError as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=503, mimetype="application/json"
+        )
+    except Exception as e:
+        logging.exception("Error in clone_plan")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=500, mimetype="application/json"
+        )
+
+
+@app.route(
+    route="getPlan/{plan_id}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"]
 )
-@app.generic_input_binding(
-    arg_name="activitiesDocs",
+@app.generic_output_binding(
+    arg_name="deleteOps",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
-    sql_query="SELECT * FROM c WHERE c.type='activity'",
-    partitionKey="{plan_id}",
 )
+@profiled
 def get_plan(
     req: func.HttpRequest,
-    planDoc: func.DocumentList,
-    datesDocs: func.DocumentList,
-    activitiesDocs: func.DocumentList,
+    deleteOps: func.Out[func.Document],
 ) -> func.HttpResponse:
     """
-    Get all plan data (includes all dates and activities).
+    Get all plan data (includes all dates and activities), or with `from`/`to`
+    query parameters, one page of the dates and activities in that range.
+
+    The full plan is rebuilt from its snapshot plus the ops logged since; the
+    settled part of the tail is compacted into a new snapshot once it grows
+    long enough. Reads go through the SDK rather than input bindings so a
+    windowed request only pays for its own query.
     """
     try:
         logging.info("Starting get_plan function")
 
+        plan_id = req.route_params.get("plan_id")
+
+        if any(req.params.get(x) for x in ("from", "to", "continuationToken")):
+            return get_plan_window(req, plan_id)
+
+        docs, ops, compaction = rebuild_plan(plan_id)
+
         # Validate plan existence
+        planDoc = docs.get(plan_id)
         if not planDoc:
             return func.HttpResponse(
                 json.dumps({"error": "Plan not found"}),
                 status_code=404,
                 mimetype="application/json",
             )
-        planDoc = planDoc[0]
 
-        # Assemble response
+        if compaction:
+            expire = write_compaction(plan_id, compaction)
+            if expire:
+                deleteOps.set([func.Document.from_dict(x) for x in expire])
+
+        # Assemble response; only ids are sorted, and the documents are
+        # encoded one at a time as the body is written
+        date_ids, activity_ids = sorted_plan_ids(docs)
         response = {
-            "plan": dict(planDoc),
-            "dates": sorted([dict(date) for date in datesDocs], key=lambda x: x["id"]),
-            "activities": sorted(
-                [dict(activity) for activity in activitiesDocs],
-                key=lambda x: (x["id"].split("|")[1], int(x["id"].split("|")[3])),
-            ),
+            "plan": planDoc,
+            "dates": (docs[x] for x in date_ids),
+            "activities": (docs[x] for x in activity_ids),
         }
 
+        return data_response({"status": "success", "data": response}, req)
+    except ArchiveUnavailableError as e:
         return func.HttpResponse(
-            json.dumps({"status": "success", "data": response}),
-            mimetype="application/json",
+            json.dumps({"error": str(e)}), status_code=503, mimetype="application/json"
         )
     except Exception as e:
         logging.exception("Error in get_plan")
@@ -281,6 +590,362 @@ def get_plan(
         )
 
 
+def rebuild_plan(
+    plan_id: str, rehydrate_archived: bool = True
+) -> Tuple[Dict[str, dict], List[dict], Optional[dict]]:
+    """
+    Get a plan's live documents keyed by id from its snapshot and op tail,
+    with the tail and, when a new snapshot is due, its contents (`upTo`,
+    `docs`) and the documents it makes obsolete (`expire`). An archived plan
+    is brought back first (ArchiveUnavailableError if it can't be), unless
+    `rehydrate_archived` is off; then only its stub plan document is
+    returned.
+    """
+    logged = list(
+        query_documents(plan_id, "SELECT * FROM c WHERE c.type IN ('snapshot', 'op')")
+    )
+    snapshot, stale = load_snapshot(x for x in logged if x["type"] == "snapshot")
+    ops = tail_ops(snapshot, (x for x in logged if x["type"] == "op"))
+    up_to = fold_boundary()
+    settled = [op for op in ops if op["id"] < up_to]
+    compact = len(ops) >= SNAPSHOT_EVERY and bool(settled)
+    if snapshot:
+        docs = snapshot["docs"]
+        stale_ids = {x["id"] for x in stale}
+        previous = [
+            x for x in logged if x["type"] == "snapshot" and x["id"] not in stale_ids
+        ]
+    elif is_complete_log(ops):
+        docs = {}
+        previous = []
+    else:
+        # Plan predates the op log; its documents already include the ops
+        docs = query_plan_documents(plan_id)
+        if docs.get(plan_id, {}).get("archived"):
+            if rehydrate_archived:
+                rehydrate(plan_id)
+                return rebuild_plan(plan_id, rehydrate_archived=False)
+            return docs, ops, None
+        return docs, ops, {"upTo": up_to, "docs": docs, "expire": settled + stale}
+
+    if not compact:
+        return apply_ops(docs, ops), ops, None
+    apply_ops(docs, settled)
+    compaction = {
+        "upTo": up_to,
+        "docs": {x: dict(doc) for x, doc in docs.items()},
+        "expire": settled + stale + previous,
+    }
+    return apply_ops(docs, ops[len(settled) :]), ops, compaction
+
+
+def write_compaction(plan_id: str, compaction: dict) -> List[dict]:
+    """
+    Write the snapshot of a compaction from `rebuild_plan`; returns the
+    documents it makes obsolete, marked for deletion. They must only be
+    written once the new snapshot is in place.
+    """
+    chunks = snapshot_docs(plan_id, compaction["docs"], compaction["upTo"])
+    container = get_container()
+    for chunk in chunks:
+        container.upsert_item(chunk)
+    logging.info(
+        f"Compacted ops up to {compaction['upTo']} into a snapshot of plan "
+        f"{plan_id} in {len(chunks)} chunks"
+    )
+    return expired(compaction["expire"])
+
+
+def sorted_plan_ids(docs: Dict[str, dict]) -> Tuple[List[str], List[str]]:
+    """
+    Date ids and activity ids of a plan, each in display order.
+    """
+    date_ids = sorted(x for x, doc in docs.items() if doc["type"] == "date")
+    activity_ids = sorted(
+        (x for x, doc in docs.items() if doc["type"] == "activity"),
+        key=activity_sort_key,
+    )
+    return date_ids, activity_ids
+
+
+def get_plan_window(req: func.HttpRequest, plan_id: str) -> func.HttpResponse:
+    """
+    Get one page of the dates (and their activities) between `from` and `to`
+    (inclusive, YYYY-MM-DD; either may be left open).
+    """
+    date_from = req.params.get("from")
+    date_to = req.params.get("to")
+    continuation_token = req.params.get("continuationToken")
+    try:
+        # Bounds compare as strings, so only the canonical form will do
+        for bound in (date_from, date_to):
+            if bound and date.fromisoformat(bound).isoformat() != bound:
+                raise ValueError(f"Invalid date '{bound}', expected YYYY-MM-DD")
+        page_size = int(req.params.get("pageSize", MAX_WINDOW_PAGE_SIZE))
+        if not 1 <= page_size <= MAX_WINDOW_PAGE_SIZE:
+            raise ValueError(f"pageSize must be between 1 and {MAX_WINDOW_PAGE_SIZE}")
+    except ValueError as e:
+        return func.HttpResponse(
+            json.dumps({"error": f"Invalid window: {e}"}),
+            status_code=400,
+            mimetype="application/json",
+        )
+
+    planDoc = read_document(plan_id, plan_id)
+    if planDoc and planDoc.get("archived"):
+        rehydrate(plan_id)
+        planDoc = read_document(plan_id, plan_id)
+    if not planDoc:
+        return func.HttpResponse(
+            json.dumps({"error": "Plan not found"}),
+            status_code=404,
+            mimetype="application/json",
+        )
+
+    # Ids sort by date, with a date's activities right after it; "~" sorts
+    # after "|" so the upper bound includes the last date's activities
+    docs, next_token = query_page(
+        plan_id,
+        WINDOW_QUERY,
+        page_size,
+        continuation_token,
+        parameters=[
+            {"name": "@from", "value": date_doc_id(date_from or "")},
+            {"name": "@to", "value": date_doc_id(date_to or "~") + "|~"},
+        ],
+    )
+
+    response = {
+        "plan": planDoc,
+        "dates": (doc for doc in docs if doc["type"] == "date"),
+        "activities": sorted(
+            [doc for doc in docs if doc["type"] == "activity"],
+            key=lambda x: activity_sort_key(x["id"]),
+        ),
+        "continuationToken": next_token,
+    }
+
+    return data_response({"status": "success", "data": response}, req)
+
+
+def read_plan(plan_id: str, summary: bool) -> dict:
+    """
+    One plan's entry in a getPlans response: the plan as getPlan returns it,
+    or with `summary`, the plan document and the extent of its itinerary.
+    """
+    try:
+        # Summaries of archived plans come from their stubs, so a dashboard
+        # listing old trips doesn't bring them all back
+        docs, _, _ = rebuild_plan(plan_id, rehydrate_archived=not summary)
+        planDoc = docs.get(plan_id)
+        if not planDoc:
+            return {"planId": plan_id, "status": 404, "error": "Plan not found"}
+        date_ids, activity_ids = sorted_plan_ids(docs)
+        archived = planDoc.get("archived")
+        if summary and archived:
+            data = {
+                "plan": planDoc,
+                "dateCount": archived["dates"],
+                "activityCount": archived["activities"],
+                "firstDate": archived["firstDate"],
+                "lastDate": archived["lastDate"],
+            }
+        elif summary:
+            data = {
+                "plan": planDoc,
+                "dateCount": len(date_ids),
+                "activityCount": len(activity_ids),
+                "firstDate": parse_date_id(date_ids[0]) if date_ids else None,
+                "lastDate": parse_date_id(date_ids[-1]) if date_ids else None,
+            }
+        else:
+            data = {
+                "plan": planDoc,
+                "dates": [docs[x] for x in date_ids],
+                "activities": [docs[x] for x in activity_ids],
+            }
+        return {"planId": plan_id, "status": 200, "data": data}
+    except ArchiveUnavailableError as e:
+        return {"planId": plan_id, "status": 503, "error": str(e)}
+    except Exception as e:
+        logging.exception(f"Error reading plan {plan_id} in get_plans")
+        return {"planId": plan_id, "status": 500, "error": str(e)}
+
+
+@app.route(route="getPlans", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"])
+@profiled
+def get_plans(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Get several plans in one request, e.g. for a dashboard: `ids` is a
+    comma-separated list of plan ids, and `summary=true` returns each plan's
+    document and date range instead of all its dates and activities.
+
+    Plans are read concurrently, at most `GET_PLANS_CONCURRENCY` at a time
+    per instance. Each plan has its own status, so one missing plan doesn't
+    fail the rest. Unlike getPlan, nothing is compacted here.
+    """
+    try:
+        logging.info("Starting get_plans function")
+
+        plan_ids_param = [x.strip() for x in req.params.get("ids", "").split(",")]
+        requested = list(dict.fromkeys(x for x in plan_ids_param if x))
+        if not requested or len(requested) > MAX_PLANS_PER_REQUEST:
+            return func.HttpResponse(
+                json.dumps(
+                    {
+                        "error": "ids must list between 1 and "
+                        f"{MAX_PLANS_PER_REQUEST} plan ids"
+                    }
+                ),
+                status_code=400,
+                mimetype="application/json",
+            )
+        summary = req.params.get("summary", "").lower() == "true"
+
+        results = list(
+            plan_reader.map(lambda plan_id: read_plan(plan_id, summary), requested)
+        )
+
+        return data_response({"status": "success", "data": results}, req)
+    except Exception as e:
+        logging.exception("Error in get_plans")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=500, mimetype="application/json"
+        )
+
+
+@app.route(
+    route="getRanking/{plan_id}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"]
+)
+@app.generic_input_binding(
+    arg_name="rankingDoc",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+    id="ranking",
+    partitionKey="{plan_id}",
+)
+@profiled
+def get_ranking(
+    req: func.HttpRequest, rankingDoc: func.DocumentList
+) -> func.HttpResponse:
+    """
+    Get the voted activities of each date, best first.
+    """
+    try:
+        logging.info("Starting get_ranking function")
+
+        plan_id = req.route_params.get("plan_id")
+        date_id = req.params.get("date")
+        try:
+            top = int(req.params["top"]) if req.params.get("top") else None
+        except ValueError:
+            return func.HttpResponse(
+                json.dumps({"error": "top must be an integer"}),
+                status_code=400,
+                mimetype="application/json",
+            )
+
+        dates = load_ranking(plan_id, rankingDoc)["dates"]
+        if date_id:
+            dates = {date_id: dates.get(date_id, [])}
+        if top is not None:
+            dates = {x: entries[:top] for x, entries in dates.items()}
+
+        return func.HttpResponse(
+            json.dumps(
+                {"status": "success", "data": {"planId": plan_id, "dates": dates}}
+            ),
+            mimetype="application/json",
+        )
+    except Exception as e:
+        logging.exception("Error in get_ranking")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=500, mimetype="application/json"
+        )
+
+
+@app.route(
+    route="exportPlan/{plan_id}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"]
+)
+@profiled
+def export_plan(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Export all documents of a plan as NDJSON (one document per line).
+    """
+    try:
+        logging.info("Starting export_plan function")
+
+        plan_id = req.route_params.get("plan_id")
+
+        # An archived plan's documents are in its archive, not the container
+        planDoc = read_document(plan_id, plan_id)
+        if planDoc and planDoc.get("archived"):
+            rehydrate(plan_id)
+
+        # Documents are encoded as the query pages arrive; nothing is sorted
+        docs = iter_plan_documents(get_container(), plan_id)
+        first = next(docs, None)
+        if first is None:
+            return func.HttpResponse(
+                json.dumps({"error": f"Plan '{plan_id}' not found"}),
+                status_code=404,
+                mimetype="application/json",
+            )
+
+        return StreamingHttpResponse(
+            chunked(iter_ndjson(itertools.chain([first], docs))),
+            mimetype="application/x-ndjson",
+        )
+    except ArchiveUnavailableError as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=503, mimetype="application/json"
+        )
+    except Exception as e:
+        logging.exception("Error in export_plan")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=500, mimetype="application/json"
+        )
+
+
+@app.route(
+    route="listPlans/{user}", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"]
+)
+@profiled
+def list_plans(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    List the plans a user created or participates in, most recent first.
+    """
+    try:
+        logging.info("Starting list_plans function")
+
+        user = req.route_params.get("user")
+        continuation_token = req.params.get("continuationToken")
+        try:
+            page_size = min(int(req.params.get("pageSize", 20)), 100)
+        except ValueError:
+            page_size = 0
+        if page_size < 1:
+            return func.HttpResponse(
+                json.dumps({"error": "pageSize must be an integer between 1 and 100"}),
+                status_code=400,
+                mimetype="application/json",
+            )
+
+        page = list_user_plans(user, page_size, continuation_token)
+
+        return func.HttpResponse(
+            json.dumps({"status": "success", "data": page}),
+            mimetype="application/json",
+        )
+    except Exception as e:
+        logging.exception("Error in list_plans")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}), status_code=500, mimetype="application/json"
+        )
+
+
 @app.route(
     route="deletePlan/{plan_id}",
     methods=["DELETE"],
@@ -302,17 +967,27 @@ def get_plan(
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
 )
+@app.generic_output_binding(
+    arg_name="opLog",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def delete_plan(
     req: func.HttpRequest,
     inputDoc: func.DocumentList,
     signalR: func.Out[str],
     deleteDoc: func.Out[func.Document],
+    opLog: func.Out[str],
 ) -> func.HttpResponse:
     """
     Delete existing plan.
@@ -334,6 +1009,10 @@ def delete_plan(
         inputDoc["ttl"] = 1
         deleteDoc.set(inputDoc)
 
+        opLog.set(json.dumps(op_doc(plan_id, "planDeleted", None, deleted=[plan_id])))
+        plan_ids.forget(plan_id)
+        forget_plan(plan_id)
+
         logging.info(f"Document marked for deletion: {plan_id}")
 
         # Send SignalR message to clients
@@ -366,34 +1045,13 @@ def initialize_dates(
     dates_return_data = []
     activities_return_data = []
     for date in dates:
-        date_id = f"date|{date['id']}"
-
         # Build date document
-        doc = {
-            "plan": plan_id,
-            "id": date_id,
-            "type": "date",
-            "createdBy": created_by,
-            "createdAt": current_time,
-            "lastUpdatedBy": created_by,
-            "lastUpdatedAt": current_time,
-        }
+        doc = DateDoc(plan_id, date["id"], created_by, current_time).to_doc()
         docs.append(doc)
         dates_return_data.append(doc)
 
-        activity_id = f"{date_id}|activity|0"
-
         # Build empty activity document
-        doc = {
-            "plan": plan_id,
-            "id": activity_id,
-            "type": "activity",
-            "activityText": "",
-            "createdBy": created_by,
-            "createdAt": current_time,
-            "lastUpdatedBy": created_by,
-            "lastUpdatedAt": current_time,
-        }
+        doc = ActivityDoc(plan_id, date["id"], 0, created_by, current_time).to_doc()
         docs.append(doc)
         activities_return_data.append(doc)
 
@@ -412,14 +1070,26 @@ def initialize_dates(
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
 )
+@app.generic_output_binding(
+    arg_name="opLog",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def add_date(
-    req: func.HttpRequest, outputDocDate: func.Out[str], signalR: func.Out[str]
+    req: func.HttpRequest,
+    outputDocDate: func.Out[str],
+    opLog: func.Out[str],
+    signalR: func.Out[str],
 ) -> func.HttpResponse:
     """
     Add new date item.
@@ -459,6 +1129,20 @@ def add_date(
             dates=[date_data],
             created_by=created_by,
         )
+        opLog.set(
+            json.dumps(
+                op_doc(
+                    plan_id,
+                    "dateAdded",
+                    created_by,
+                    put=[*docs["dates"], *docs["activities"]],
+                )
+            )
+        )
+        plan_ids.add(
+            plan_id, *(doc["id"] for doc in (*docs["dates"], *docs["activities"]))
+        )
+        touch_user_plan(created_by, plan_id)
 
         # Send SignalR message to clients
         sync_args = [{"id": date_data.get("id"), "byUser": created_by}]
@@ -484,26 +1168,15 @@ def add_date(
     methods=["DELETE"],
     auth_level=func.AuthLevel.ANONYMOUS,
 )
-@app.generic_input_binding(
-    arg_name="inputDoc",
-    type="cosmosDB",
-    connection_string_setting=COSMOS_CONN_STRING,
-    database_name=COSMOS_DB_NAME,
-    container_name=COSMOS_CONTAINER_NAME,
-    id="date|{date_id}",
-    partitionKey="{plan_id}",
-)
-@app.generic_input_binding(
-    arg_name="activityDocs",
+@app.generic_output_binding(
+    arg_name="deleteDoc",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
-    sql_query="SELECT * FROM c WHERE c.type='activity'",
-    partitionKey="{plan_id}",
 )
 @app.generic_output_binding(
-    arg_name="deleteDoc",
+    arg_name="opLog",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
@@ -515,17 +1188,17 @@ def add_date(
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def delete_date(
     req: func.HttpRequest,
-    inputDoc: func.DocumentList,
     signalR: func.Out[str],
     deleteDoc: func.Out[func.Document],
-    activityDocs: func.DocumentList,
+    opLog: func.Out[str],
 ) -> func.HttpResponse:
     """
     Delete date item.
     """
-    print(activityDocs)
     try:
         logging.info("Starting delete_date function")
 
@@ -534,6 +1207,7 @@ def delete_date(
         date_id = req.route_params.get("date_id")
         user_name = req.route_params.get("user_name")
 
+        inputDoc = read_document(plan_id, date_doc_id(date_id))
         if not inputDoc:
             return func.HttpResponse(
                 json.dumps(
@@ -545,34 +1219,48 @@ def delete_date(
 
         # Mark doc for deletion
         docs_to_delete = []
-        inputDoc = list(inputDoc)[0]
         inputDoc["ttl"] = 1
         docs_to_delete.append(func.Document.from_dict(inputDoc))
 
         logging.info(f"Date document marked for deletion: {date_id}")
 
-        for activityDoc in activityDocs:
-            # This is probably bad, but seem to be limited by CosmosDB, our at least our schema
-            if activityDoc["id"].startswith(f"date|{date_id}|activity|"):
-                activityDoc["ttl"] = 1
-                logging.info(
-                    f"Activity document marked for deletion: {activityDoc['id']}"
-                )
-                docs_to_delete.append(func.Document.from_dict(activityDoc))
+        # Only the date's own activities
+        for activityDoc in query_documents(
+            plan_id,
+            DATE_ACTIVITIES_QUERY,
+            [{"name": "@prefix", "value": activity_prefix(date_id)}],
+        ):
+            activityDoc["ttl"] = 1
+            logging.info(f"Activity document marked for deletion: {activityDoc['id']}")
+            docs_to_delete.append(func.Document.from_dict(activityDoc))
 
         deleteDoc.set(docs_to_delete)
-
-        # Send SignalR message to clients
-        sync_args = [{"id": date_id, "byUser": user_name}]
-        signalR.set(
+        plan_ids.discard(plan_id, *(doc["id"] for doc in docs_to_delete))
+        ranking = update_ranking(plan_id, lambda ranking: remove(ranking, date_id))
+        opLog.set(
             json.dumps(
-                {
-                    "target": "dateDeleted",
-                    "arguments": sync_args,
-                    "groupName": plan_id,
-                }
+                op_doc(
+                    plan_id,
+                    "dateDeleted",
+                    user_name,
+                    deleted=[doc["id"] for doc in docs_to_delete],
+                )
             )
         )
+        touch_user_plan(user_name, plan_id)
+
+        # Send SignalR message to clients
+        sync_args = [{"id": date_id, "byUser": user_name}]
+        messages = [
+            {
+                "target": "dateDeleted",
+                "arguments": sync_args,
+                "groupName": plan_id,
+            }
+        ]
+        if ranking:
+            messages.append(ranking_message(plan_id, ranking, [date_id]))
+        signalR.set(json.dumps(messages))
 
         return func.HttpResponse(
             json.dumps({"status": "success", "id": date_id}),
@@ -597,14 +1285,26 @@ def delete_date(
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
 )
+@app.generic_output_binding(
+    arg_name="opLog",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def add_activity(
-    req: func.HttpRequest, outputDoc: func.Out[str], signalR: func.Out[str]
+    req: func.HttpRequest,
+    outputDoc: func.Out[str],
+    opLog: func.Out[str],
+    signalR: func.Out[str],
 ) -> func.HttpResponse:
     """
     Add new activity.
@@ -640,20 +1340,15 @@ def add_activity(
         activity_id = required_fields["id"]
 
         current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
-        activity_id_db = f"date|{date_id}|activity|{activity_id}"
         # Build empty activity document
-        doc = {
-            "plan": plan_id,
-            "id": activity_id_db,
-            "type": "activity",
-            "activityText": "",
-            "createdBy": created_by,
-            "createdAt": current_time,
-            "lastUpdatedBy": created_by,
-            "lastUpdatedAt": current_time,
-        }
+        doc = ActivityDoc(
+            plan_id, date_id, activity_id, created_by, current_time
+        ).to_doc()
         logging.info(f"Attempting to save document to CosmosDB: {doc}")
         outputDoc.set(json.dumps(doc))
+        opLog.set(json.dumps(op_doc(plan_id, "activityAdded", created_by, put=[doc])))
+        plan_ids.add(plan_id, doc["id"])
+        touch_user_plan(created_by, plan_id)
 
         # Send SignalR message to clients
         sync_args = [{"id": activity_id, "dateId": date_id, "byUser": created_by}]
@@ -699,17 +1394,27 @@ def add_activity(
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
 )
+@app.generic_output_binding(
+    arg_name="opLog",
+    type="cosmosDB",
+    connection_string_setting=COSMOS_CONN_STRING,
+    database_name=COSMOS_DB_NAME,
+    container_name=COSMOS_CONTAINER_NAME,
+)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def delete_activity(
     req: func.HttpRequest,
     inputDoc: func.DocumentList,
     signalR: func.Out[str],
     deleteDoc: func.Out[func.Document],
+    opLog: func.Out[str],
 ) -> func.HttpResponse:
     """
     Delete activity.
@@ -739,19 +1444,33 @@ def delete_activity(
         inputDoc["ttl"] = 1
         deleteDoc.set(inputDoc)
 
+        opLog.set(
+            json.dumps(
+                op_doc(plan_id, "activityDeleted", user_name, deleted=[inputDoc["id"]])
+            )
+        )
+        draft_buffer.discard(plan_id, inputDoc["id"])
+        plan_ids.discard(plan_id, inputDoc["id"])
+        forget_text_state(plan_id, inputDoc["id"])
+        ranking = update_ranking(
+            plan_id, lambda ranking: remove(ranking, date_id, activity_id)
+        )
+
         logging.info(f"Document marked for deletion: {activity_id}")
+        touch_user_plan(user_name, plan_id)
 
         # Send SignalR message to clients
         sync_args = [{"id": activity_id, "dateId": date_id, "byUser": user_name}]
-        signalR.set(
-            json.dumps(
-                {
-                    "target": "activityDeleted",
-                    "arguments": sync_args,
-                    "groupName": plan_id,
-                }
-            )
-        )
+        messages = [
+            {
+                "target": "activityDeleted",
+                "arguments": sync_args,
+                "groupName": plan_id,
+            }
+        ]
+        if ranking:
+            messages.append(ranking_message(plan_id, ranking, [date_id]))
+        signalR.set(json.dumps(messages))
 
         return func.HttpResponse(
             json.dumps({"status": "success", "id": activity_id}),
@@ -769,26 +1488,18 @@ def delete_activity(
     methods=["POST"],
     auth_level=func.AuthLevel.ANONYMOUS,
 )
-@app.generic_input_binding(
-    arg_name="inputDoc",
-    type="cosmosDB",
-    connection_string_setting=COSMOS_CONN_STRING,
-    database_name=COSMOS_DB_NAME,
-    container_name=COSMOS_CONTAINER_NAME,
-    id="date|{date_id}|activity|{activity_id}",
-    partitionKey="{plan_id}",
-)
 @app.generic_output_binding(
     arg_name="signalR",
     type="signalR",
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
-def lock_activity(
-    req: func.HttpRequest, inputDoc: func.DocumentList, signalR: func.Out[str]
-) -> func.HttpResponse:
+@profiled
+@idempotent
+def lock_activity(req: func.HttpRequest, signalR: func.Out[str]) -> func.HttpResponse:
     """
-    Lock activity.
+    Lock activity. Existence is checked against the plan's id set, so no
+    document is read.
     """
     try:
         logging.info("Starting lock_activity function")
@@ -818,7 +1529,7 @@ def lock_activity(
                 mimetype="application/json",
             )
 
-        if not inputDoc:
+        if not plan_ids.exists(plan_id, activity_doc_id(date_id, activity_id)):
             return func.HttpResponse(
                 json.dumps(
                     {
@@ -865,24 +1576,22 @@ def lock_activity(
     methods=["PATCH"],
     auth_level=func.AuthLevel.ANONYMOUS,
 )
-@app.generic_input_binding(
-    arg_name="inputDoc",
+@app.generic_output_binding(
+    arg_name="updateDoc",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
-    id="date|{date_id}|activity|{activity_id}",
-    partitionKey="{plan_id}",
 )
 @app.generic_output_binding(
-    arg_name="updateDoc",
+    arg_name="deleteDoc",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
 )
 @app.generic_output_binding(
-    arg_name="deleteDoc",
+    arg_name="opLog",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
@@ -894,15 +1603,23 @@ def lock_activity(
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def update_activity(
     req: func.HttpRequest,
-    inputDoc: func.DocumentList,
     signalR: func.Out[str],
     updateDoc: func.Out[func.Document],
     deleteDoc: func.Out[func.Document],
+    opLog: func.Out[str],
 ) -> func.HttpResponse:
     """
     Update activity.
+
+    The new text is sent either whole (`activityText`) or as edit ops against
+    a revision (`ops` + `rev`, see text_ops.py), in which case concurrent
+    edits are merged and only the ops are broadcast. The activity is only
+    read once the request is valid; non-final edits just need to know it
+    exists, unless this instance has yet to seed its text for ops.
     """
     try:
         logging.info("Starting update_activity function")
@@ -915,11 +1632,19 @@ def update_activity(
         logging.info(f"activity_data: {activity_data}")
 
         # Validate required JSON fields
-        required_fields = {
-            "activityText": activity_data.get("activityText"),
-            "updatedBy": activity_data.get("updatedBy"),
-            "isFinal": activity_data.get("isFinal"),
-        }
+        if "ops" in activity_data:
+            required_fields = {
+                "ops": activity_data.get("ops"),
+                "rev": activity_data.get("rev"),
+            }
+        else:
+            required_fields = {"activityText": activity_data.get("activityText")}
+        required_fields.update(
+            {
+                "updatedBy": activity_data.get("updatedBy"),
+                "isFinal": activity_data.get("isFinal"),
+            }
+        )
         missing_fields = [x for x, y in required_fields.items() if y is None]
         if missing_fields:
             return func.HttpResponse(
@@ -933,7 +1658,23 @@ def update_activity(
                 mimetype="application/json",
             )
 
-        if not inputDoc:
+        activity_id_db = activity_doc_id(date_id, activity_id)
+        if required_fields["isFinal"]:
+            inputDoc = read_document(plan_id, activity_id_db)
+            found = inputDoc is not None
+        else:
+            inputDoc = None
+            found = plan_ids.exists(plan_id, activity_id_db)
+        state = ranking = None
+        if found and "ops" in required_fields:
+            # Only an activity this instance hasn't edited before is read
+            state = get_text_state(
+                plan_id,
+                activity_id_db,
+                lambda: inputDoc or read_document(plan_id, activity_id_db),
+            )
+            found = state is not None
+        if not found:
             return func.HttpResponse(
                 json.dumps(
                     {
@@ -944,21 +1685,64 @@ def update_activity(
                 mimetype="application/json",
             )
 
-        if required_fields["isFinal"]:
+        try:
+            if "ops" in required_fields:
+                # Merge the edit into the stored revision history
+                applied_ops, rev, text = state.submit(
+                    validate_ops(required_fields["ops"]),
+                    int(required_fields["rev"]),
+                    required_fields["updatedBy"],
+                )
+                required_fields["activityText"] = text
+            elif required_fields["isFinal"]:
+                # Later edits are made against the new text
+                state = get_text_state(plan_id, activity_id_db, lambda: inputDoc)
+                rev = state.reset(
+                    required_fields["activityText"], required_fields["updatedBy"]
+                )
+            else:
+                # Non-final whole-text edits only go to the draft
+                rev = None
+        except StaleRevisionError as e:
+            return func.HttpResponse(
+                json.dumps(
+                    {"error": str(e), "activityText": state.text, "rev": state.rev}
+                ),
+                status_code=409,
+                mimetype="application/json",
+            )
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json",
+            )
+
+        if not required_fields["isFinal"]:
+            # Keep the latest text; it is written behind on a timer
+            draft_buffer.put(
+                plan_id,
+                activity_id_db,
+                required_fields["activityText"],
+                required_fields["updatedBy"],
+            )
+        else:
+            draft_buffer.discard(plan_id, activity_id_db)
+
             # Determine if activity needs to be moved
-            inputDoc = list(inputDoc)[0]
             prev_activity_id = inputDoc.get("id")
-            activity_id_db = f"date|{date_id}|activity|{activity_id}"
+
+            current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
+            activity = ActivityDoc.from_doc(inputDoc)
+            activity.activity_text = required_fields["activityText"]
+            # Votes move lastUpdatedAt too; drafts are judged by textUpdatedAt
+            activity.set_fields(rev=rev, draft=None, textUpdatedAt=current_time)
+            activity.touch(required_fields["updatedBy"], current_time)
 
             if activity_id_db != prev_activity_id:
                 # Move activity
-                newDoc = dict(inputDoc)
-                newDoc["id"] = activity_id_db
-                newDoc["activityText"] = required_fields["activityText"]
-                newDoc["lastUpdatedBy"] = required_fields["updatedBy"]
-                newDoc["lastUpdatedAt"] = int(
-                    datetime.now(timezone.utc).timestamp() * 1000
-                )
+                activity.move_to(date_id, activity_id)
+                newDoc = activity.to_doc()
                 updateDoc.set(func.Document.from_dict(newDoc))
 
                 # Mark old doc for deletion
@@ -966,19 +1750,51 @@ def update_activity(
                 oldDoc["ttl"] = 1
                 deleteDoc.set(func.Document.from_dict(oldDoc))
 
+                op = op_doc(
+                    plan_id,
+                    "activityUpdated",
+                    required_fields["updatedBy"],
+                    put=[newDoc],
+                    deleted=[prev_activity_id],
+                )
+
+                plan_ids.discard(plan_id, prev_activity_id)
+                plan_ids.add(plan_id, activity_id_db)
+                forget_text_state(plan_id, prev_activity_id)
+                prev_date_id, prev_index = parse_activity_id(prev_activity_id)
+                ranking = update_ranking(
+                    plan_id,
+                    lambda ranking: move(
+                        ranking, prev_date_id, prev_index, date_id, activity_id
+                    ),
+                )
+
                 logging.info(f"Activity moved: {prev_activity_id} -> {activity_id_db}")
                 responseDoc = newDoc
             else:
                 # Update existing doc
-                inputDoc["activityText"] = required_fields["activityText"]
-                inputDoc["lastUpdatedBy"] = required_fields["updatedBy"]
-                inputDoc["lastUpdatedAt"] = int(
-                    datetime.now(timezone.utc).timestamp() * 1000
+                responseDoc = activity.to_doc()
+                updateDoc.set(func.Document.from_dict(responseDoc))
+                op = op_doc(
+                    plan_id,
+                    "activityUpdated",
+                    required_fields["updatedBy"],
+                    updates={
+                        activity_id_db: {
+                            "activityText": activity.activity_text,
+                            "rev": rev,
+                            "draft": None,
+                            "textUpdatedAt": current_time,
+                            "lastUpdatedBy": activity.last_updated_by,
+                            "lastUpdatedAt": activity.last_updated_at,
+                        }
+                    },
                 )
-                updateDoc.set(inputDoc)
 
                 logging.info(f"Activity updated: {activity_id_db}")
-                responseDoc = dict(inputDoc)
+
+            opLog.set(json.dumps(op))
+            touch_user_plan(required_fields["updatedBy"], plan_id)
 
         # Send SignalR message to clients
         sync_args = [
@@ -990,15 +1806,25 @@ def update_activity(
                 "byUser": required_fields["updatedBy"],
             }
         ]
-        signalR.set(
-            json.dumps(
-                {
-                    "target": "activityUpdated",
-                    "arguments": sync_args,
-                    "groupName": plan_id,
-                }
-            )
-        )
+        if "ops" in required_fields:
+            # Ops are enough to follow along; the final update carries the text
+            sync_args[0].update({"ops": applied_ops, "rev": rev})
+            if not required_fields["isFinal"]:
+                del sync_args[0]["activityText"]
+        elif rev is not None:
+            sync_args[0]["rev"] = rev
+        messages = [
+            {
+                "target": "activityUpdated",
+                "arguments": sync_args,
+                "groupName": plan_id,
+            }
+        ]
+        if ranking:
+            # Only a move changes the ranking, of both dates
+            ranked_dates = list(dict.fromkeys((prev_date_id, date_id)))
+            messages.append(ranking_message(plan_id, ranking, ranked_dates))
+        signalR.set(json.dumps(messages))
 
         return func.HttpResponse(
             json.dumps({"status": "success", "activity": sync_args}),
@@ -1016,17 +1842,15 @@ def update_activity(
     methods=["PATCH"],
     auth_level=func.AuthLevel.ANONYMOUS,
 )
-@app.generic_input_binding(
-    arg_name="inputDoc",
+@app.generic_output_binding(
+    arg_name="updateDoc",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
     container_name=COSMOS_CONTAINER_NAME,
-    id="date|{date_id}|activity|{activity_id}",
-    partitionKey="{plan_id}",
 )
 @app.generic_output_binding(
-    arg_name="updateDoc",
+    arg_name="opLog",
     type="cosmosDB",
     connection_string_setting=COSMOS_CONN_STRING,
     database_name=COSMOS_DB_NAME,
@@ -1038,11 +1862,13 @@ def update_activity(
     hub_name=SIGNALR_HUB_NAME,
     connection_string_setting=SIGNALR_CONN_STRING,
 )
+@profiled
+@idempotent
 def vote_activity(
     req: func.HttpRequest,
-    inputDoc: func.DocumentList,
     signalR: func.Out[str],
     updateDoc: func.Out[func.Document],
+    opLog: func.Out[str],
 ) -> func.HttpResponse:
     """
     Vote activity.
@@ -1076,6 +1902,8 @@ def vote_activity(
                 mimetype="application/json",
             )
 
+        activity_id_db = activity_doc_id(date_id, activity_id)
+        inputDoc = read_document(plan_id, activity_id_db)
         if not inputDoc:
             return func.HttpResponse(
                 json.dumps(
@@ -1087,21 +1915,48 @@ def vote_activity(
                 mimetype="application/json",
             )
 
-        # Determine if activity needs to be moved
-        inputDoc = list(inputDoc)[0]
-        activity_id_db = f"date|{date_id}|activity|{activity_id}"
-
-        
         # Update existing doc
-        inputDoc["upVoters"] = required_fields["upVoters"]
-        inputDoc["downVoters"] = required_fields["downVoters"]
-        inputDoc["lastUpdatedBy"] = required_fields["voter"]
-        inputDoc["lastUpdatedAt"] = int(
-            datetime.now(timezone.utc).timestamp() * 1000
+        activity = ActivityDoc.from_doc(inputDoc)
+        activity.set_fields(
+            upVoters=required_fields["upVoters"],
+            downVoters=required_fields["downVoters"],
+        )
+        activity.touch(
+            required_fields["voter"],
+            int(datetime.now(timezone.utc).timestamp() * 1000),
+        )
+        updateDoc.set(func.Document.from_dict(activity.to_doc()))
+        opLog.set(
+            json.dumps(
+                op_doc(
+                    plan_id,
+                    "activityVoted",
+                    required_fields["voter"],
+                    updates={
+                        activity_id_db: {
+                            "upVoters": required_fields["upVoters"],
+                            "downVoters": required_fields["downVoters"],
+                            "lastUpdatedBy": activity.last_updated_by,
+                            "lastUpdatedAt": activity.last_updated_at,
+                        }
+                    },
+                )
+            )
+        )
+
+        ranking = update_ranking(
+            plan_id,
+            lambda ranking: set_votes(
+                ranking,
+                date_id,
+                activity_id,
+                required_fields["upVoters"],
+                required_fields["downVoters"],
+            ),
         )
-        updateDoc.set(inputDoc)
 
         logging.info(f"Activity votes updated: {activity_id_db}")
+        touch_user_plan(required_fields["voter"], plan_id)
 
         # Send SignalR message to clients
         sync_args = [
@@ -1113,15 +1968,16 @@ def vote_activity(
                 "dateId": date_id,
             }
         ]
-        signalR.set(
-            json.dumps(
-                {
-                    "target": "voteActivity",
-                    "arguments": sync_args,
-                    "groupName": plan_id,
-                }
-            )
-        )
+        messages = [
+            {
+                "target": "voteActivity",
+                "arguments": sync_args,
+                "groupName": plan_id,
+            }
+        ]
+        if ranking:
+            messages.append(ranking_message(plan_id, ranking, [date_id]))
+        signalR.set(json.dumps(messages))
 
         return func.HttpResponse(
             json.dumps({"status": "success", "activity": sync_args}),
@@ -0,0 +1,316 @@
+"""
+In-process WebSocket broadcast hub, a local stand-in for Azure SignalR.
+
+It speaks enough of the SignalR hub protocols, JSON and (with `msgpack`
+installed) MessagePack, for `@microsoft/signalr` clients (negotiate,
+handshake, invocations, pings) and accepts the same
+messages the handlers give their `signalR` output binding:
+
+    {"target": ..., "arguments": [...], "groupName": ...}     send to a group
+    {"target": ..., "arguments": [...]}                       send to everyone
+    {"connectionId": ..., "groupName": ..., "action": "add"}  join a group
+
+Each connection has a bounded send queue. When a slow client's queue is
+full, `policy` decides what gives: "drop_oldest" (default) discards its
+oldest queued message, "drop_newest" the incoming one, "disconnect" closes
+the connection. `metrics()` reports fan-out sizes, drops and queue depth.
+
+State lives in one process; serve with a single worker when using the hub.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+from wire import PROTOCOLS, RECORD_SEPARATOR, hub_frame, parse_hub_frames
+
+PING_INTERVAL_SECONDS = 15
+# Negotiated connections not opened within this long are forgotten
+PENDING_TTL_SECONDS = 60
+POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+
+_PING = {p: hub_frame(p, {"type": 6}) for p in PROTOCOLS}
+_CLOSE = {p: hub_frame(p, {"type": 7}) for p in PROTOCOLS}
+
+
+class Connection:
+    __slots__ = (
+        "id",
+        "token",
+        "protocol",
+        "queue",
+        "groups",
+        "dropped",
+        "closed",
+        "sent",
+    )
+
+    def __init__(self, connection_id: str, token: str, protocol: str, queue_size: int):
+        self.id = connection_id
+        self.token = token
+        self.protocol = protocol
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.groups: Set[str] = set()
+        self.dropped = 0
+        self.sent = 0
+        self.closed = False
+
+
+class BroadcastHub:
+    def __init__(
+        self,
+        queue_size: int = int(os.environ.get("HUB_QUEUE_SIZE", 256)),
+        policy: str = os.environ.get("HUB_DROP_POLICY", "drop_oldest"),
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"Unknown drop policy '{policy}'; expected one of {POLICIES}"
+            )
+        self.queue_size = queue_size
+        self.policy = policy
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Negotiated but not yet connected: token -> (connection id, expiry),
+        # in negotiation order
+        self.pending: Dict[str, Tuple[str, float]] = {}
+        self.connections: Dict[str, Connection] = {}
+        self.groups: Dict[str, Set[str]] = {}
+        self.stats = {
+            "messages": 0,
+            "deliveries": 0,
+            "dropped": 0,
+            "disconnectedSlow": 0,
+            "maxFanout": 0,
+        }
+
+    # Messages from handlers (any thread)
+
+    def publish(self, value) -> None:
+        """
+        Accept a `signalR` output binding value: a message, a list of them, or
+        their JSON encoding.
+        """
+        if isinstance(value, (str, bytes)):
+            value = json.loads(value)
+        messages = value if isinstance(value, list) else [value]
+        if self.loop is None:
+            # Nobody has connected yet, so there is nobody to deliver to
+            return
+        for message in messages:
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+
+    def _dispatch(self, message: dict) -> None:
+        if "action" in message:
+            self._group_action(message)
+        else:
+            self._fanout(message)
+
+    def _group_action(self, message: dict) -> None:
+        connection = self.connections.get(message.get("connectionId"))
+        group = message.get("groupName")
+        if connection is None or not group:
+            return
+        if message["action"] == "add":
+            self.groups.setdefault(group, set()).add(connection.id)
+            connection.groups.add(group)
+        elif message["action"] == "remove":
+            self.groups.get(group, set()).discard(connection.id)
+            connection.groups.discard(group)
+
+    def _fanout(self, message: dict) -> None:
+        group = message.get("groupName")
+        targets = self.groups.get(group, ()) if group else self.connections.keys()
+        invocation = {
+            "type": 1,
+            "target": message["target"],
+            "arguments": message.get("arguments", []),
+        }
+        # Encode once per protocol, however many recipients
+        frames = {}
+        self.stats["messages"] += 1
+        self.stats["maxFanout"] = max(self.stats["maxFanout"], len(targets))
+        for connection_id in list(targets):
+            connection = self.connections.get(connection_id)
+            if connection is not None:
+                frame = frames.get(connection.protocol)
+                if frame is None:
+                    frame = frames[connection.protocol] = hub_frame(
+                        connection.protocol, invocation
+                    )
+                self._enqueue(connection, frame)
+
+    def _enqueue(self, connection: Connection, frame) -> None:
+        self.stats["deliveries"] += 1
+        if not connection.queue.full():
+            connection.queue.put_nowait(frame)
+            return
+        if self.policy == "disconnect":
+            self.stats["disconnectedSlow"] += 1
+            logging.info(f"Disconnecting slow connection {connection.id}")
+            self._close(connection)
+            return
+        connection.dropped += 1
+        self.stats["dropped"] += 1
+        if self.policy == "drop_oldest":
+            connection.queue.get_nowait()
+            connection.queue.put_nowait(frame)
+
+    def _close(self, connection: Connection) -> None:
+        if connection.closed:
+            return
+        connection.closed = True
+        self.connections.pop(connection.id, None)
+        for group in connection.groups:
+            members = self.groups.get(group)
+            if members is not None:
+                members.discard(connection.id)
+                if not members:
+                    del self.groups[group]
+        # Wake the sender so it notices the close
+        while not connection.queue.empty():
+            connection.queue.get_nowait()
+        connection.queue.put_nowait(_CLOSE[connection.protocol])
+
+    def metrics(self) -> dict:
+        depths = [c.queue.qsize() for c in self.connections.values()]
+        return dict(
+            self.stats,
+            connections=len(self.connections),
+            groups=len(self.groups),
+            avgFanout=(
+                round(self.stats["deliveries"] / self.stats["messages"], 2)
+                if self.stats["messages"]
+                else 0
+            ),
+            maxQueueDepth=max(depths, default=0),
+        )
+
+    # Negotiate and connection info
+
+    def negotiate(self) -> dict:
+        now = time.monotonic()
+        # Clients that negotiated and never connected
+        while self.pending:
+            oldest = next(iter(self.pending))
+            if self.pending[oldest][1] > now:
+                break
+            del self.pending[oldest]
+        connection_id = uuid.uuid4().hex
+        token = uuid.uuid4().hex
+        self.pending[token] = (connection_id, now + PENDING_TTL_SECONDS)
+        return {
+            "negotiateVersion": 1,
+            "connectionId": connection_id,
+            "connectionToken": token,
+            "availableTransports": [
+                {
+                    "transport": "WebSockets",
+                    "transferFormats": (
+                        ["Text", "Binary"] if len(PROTOCOLS) > 1 else ["Text"]
+                    ),
+                }
+            ],
+        }
+
+    # ASGI transport
+
+    async def __call__(self, scope, receive, send, path: str):
+        """
+        Serve `POST {hub}/negotiate` and the `{hub}` WebSocket; `path` is the
+        part of the request path after the hub's mount point.
+        """
+        self.loop = self.loop or asyncio.get_running_loop()
+        if scope["type"] == "http":
+            if path.rstrip("/") != "/negotiate" or scope["method"] not in (
+                "POST",
+                "OPTIONS",
+            ):
+                return await _http(send, 404, {"error": "Not found"})
+            return await _http(send, 200, self.negotiate())
+        if scope["type"] == "websocket":
+            await self._serve(scope, receive, send)
+
+    async def _serve(self, scope, receive, send) -> None:
+        query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        connection_id, expires_at = self.pending.pop(query.get("id", ""), (None, 0))
+        if expires_at < time.monotonic():
+            connection_id = None
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        if connection_id is None:
+            await send({"type": "websocket.close", "code": 4401})
+            return
+        await send({"type": "websocket.accept"})
+
+        # Handshake, always JSON: {"protocol": "json", "version": 1}
+        message = await receive()
+        handshake = message.get("text") or (message.get("bytes") or b"").decode()
+        protocol = json.loads(handshake.rstrip(RECORD_SEPARATOR) or "{}").get(
+            "protocol"
+        )
+        if protocol not in PROTOCOLS:
+            await send(
+                {
+                    "type": "websocket.send",
+                    "text": json.dumps(
+                        {"error": f"Protocol '{protocol}' is not supported"}
+                    )
+                    + RECORD_SEPARATOR,
+                }
+            )
+            await send({"type": "websocket.close"})
+            return
+        await send({"type": "websocket.send", "text": "{}" + RECORD_SEPARATOR})
+
+        connection = Connection(connection_id, query["id"], protocol, self.queue_size)
+        self.connections[connection_id] = connection
+        sender = asyncio.create_task(self._send_loop(connection, send))
+        pinger = asyncio.create_task(self._ping_loop(connection))
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                # Clients only ping or close; invocations have no server methods
+                data = message.get("text") or message.get("bytes")
+                if data and any(x[0] == 7 for x in parse_hub_frames(protocol, data)):
+                    break
+        finally:
+            pinger.cancel()
+            self._close(connection)
+            await asyncio.gather(sender, return_exceptions=True)
+
+    async def _send_loop(self, connection: Connection, send) -> None:
+        while True:
+            frame = await connection.queue.get()
+            key = "text" if isinstance(frame, str) else "bytes"
+            try:
+                await send({"type": "websocket.send", key: frame})
+            except Exception:
+                self._close(connection)
+                return
+            if frame is _CLOSE[connection.protocol]:
+                await send({"type": "websocket.close"})
+                return
+            connection.sent += 1
+
+    async def _ping_loop(self, connection: Connection) -> None:
+        while not connection.closed:
+            await asyncio.sleep(PING_INTERVAL_SECONDS)
+            if not connection.queue.full():
+                connection.queue.put_nowait(_PING[connection.protocol])
+
+
+async def _http(send, status: int, body: dict) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": json.dumps(body).encode()})
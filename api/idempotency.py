@@ -0,0 +1,191 @@
+"""
+`Idempotency-Key` support for mutating routes.
+
+A client retrying a request sends the same `Idempotency-Key` header. The
+first response (unless it is a 5xx) is kept for `IDEMPOTENCY_TTL_SECONDS`
+(app setting, default 600) in the plan's partition, and on the instance; a
+repeat gets that response back (with `Idempotent-Replayed: true`) without
+the handler running again, so nothing is written or broadcast twice.
+Non-final activity updates write nothing themselves (see drafts.py), so
+their responses are only kept, and looked up, on the instance.
+
+    {"plan": ..., "id": "idem|<function>|<key hash>", "type": "idempotency",
+     "fingerprint": ..., "status": 200, "body": "...", "mimetype": ...,
+     "ttl": <seconds>}
+
+Reusing a key for a different request (another body or URL) is rejected with
+422. A repeat arriving while the first attempt is still running on the same
+instance gets 409; failed attempts (5xx) are not kept, so they can be
+retried with the same key.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import azure.functions as func
+
+from storage import get_container, read_document
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 600))
+MAX_KEY_LENGTH = 255
+MAX_CACHED = 10000
+
+_cache = OrderedDict()
+_in_flight = set()
+_lock = threading.Lock()
+stats = {"requests": 0, "replayed": 0, "stored": 0, "conflicts": 0}
+
+
+def _plan_id(req: func.HttpRequest) -> Optional[str]:
+    plan_id = req.route_params.get("plan_id")
+    if plan_id:
+        return plan_id
+    # createPlan names the new plan in its body
+    try:
+        return req.get_json().get("uuid")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _fingerprint(req: func.HttpRequest) -> str:
+    digest = hashlib.sha256(f"{req.method} {req.url}\n".encode())
+    digest.update(req.get_body() or b"")
+    return digest.hexdigest()
+
+
+def _cached(key) -> Optional[dict]:
+    with _lock:
+        record = _cache.get(key)
+        if record is not None and record["expiresAt"] < time.time():
+            del _cache[key]
+            return None
+        return record
+
+
+def _remember(key, record: dict) -> None:
+    with _lock:
+        _cache[key] = record
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+
+
+def _lookup(plan_id: str, doc_id: str, durable: bool) -> Optional[dict]:
+    """
+    Find a kept response, on the instance or, for durable requests, in the
+    plan's partition; non-durable ones are never stored there.
+    """
+    record = _cached((plan_id, doc_id))
+    if record is None and durable:
+        try:
+            record = read_document(plan_id, doc_id)
+        except Exception:
+            logging.exception(f"Failed to read idempotency record {doc_id}")
+            return None
+        if record is not None:
+            record["expiresAt"] = time.time() + TTL_SECONDS
+            _remember((plan_id, doc_id), record)
+    return record
+
+
+def _durable(req: func.HttpRequest) -> bool:
+    try:
+        return req.get_json().get("isFinal") is not False
+    except (ValueError, AttributeError):
+        return True
+
+
+def _store(
+    plan_id: str, doc_id: str, fingerprint: str, response, durable: bool
+) -> None:
+    record = {
+        "plan": plan_id,
+        "id": doc_id,
+        "type": "idempotency",
+        "fingerprint": fingerprint,
+        "status": response.status_code,
+        "body": (response.get_body() or b"").decode("utf-8"),
+        "mimetype": response.mimetype,
+        "ttl": TTL_SECONDS,
+    }
+    if durable:
+        try:
+            get_container().upsert_item(record)
+            stats["stored"] += 1
+        except Exception:
+            # The instance cache still covers retries that land here
+            logging.exception(f"Failed to store idempotency record {doc_id}")
+    _remember((plan_id, doc_id), dict(record, expiresAt=time.time() + TTL_SECONDS))
+
+
+def _error(message: str, status_code: int) -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps({"error": message}),
+        status_code=status_code,
+        mimetype="application/json",
+    )
+
+
+def idempotent(handler):
+    """
+    Honor `Idempotency-Key` on a mutating route.
+    """
+    function_name = handler.__name__
+
+    @functools.wraps(handler)
+    def wrapper(req: func.HttpRequest, **kwargs):
+        key = req.headers.get(IDEMPOTENCY_HEADER)
+        plan_id = _plan_id(req) if key else None
+        if not plan_id:
+            return handler(req, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(f"{IDEMPOTENCY_HEADER} is too long", 400)
+
+        stats["requests"] += 1
+        # Keys may hold characters Cosmos ids can't
+        doc_id = f"idem|{function_name}|{hashlib.sha256(key.encode()).hexdigest()}"
+        fingerprint = _fingerprint(req)
+        durable = _durable(req)
+        record = _lookup(plan_id, doc_id, durable)
+        if record is not None:
+            if record["fingerprint"] != fingerprint:
+                return _error(
+                    f"{IDEMPOTENCY_HEADER} was already used for another request",
+                    422,
+                )
+            stats["replayed"] += 1
+            return func.HttpResponse(
+                record["body"],
+                status_code=record["status"],
+                mimetype=record["mimetype"],
+                headers={REPLAYED_HEADER: "true"},
+            )
+
+        with _lock:
+            if (plan_id, doc_id) in _in_flight:
+                stats["conflicts"] += 1
+                return _error("A request with this key is in progress", 409)
+            _in_flight.add((plan_id, doc_id))
+        try:
+            response = handler(req, **kwargs)
+            if response.status_code < 500:
+                _store(plan_id, doc_id, fingerprint, response, durable)
+            return response
+        finally:
+            with _lock:
+                _in_flight.discard((plan_id, doc_id))
+
+    return wrapper
+
+
+def metrics() -> dict:
+    with _lock:
+        return dict(stats, cached=len(_cache), inFlight=len(_in_flight))
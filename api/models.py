@@ -0,0 +1,332 @@
+"""
+Typed models for plan, date and activity documents, and the codec for their
+composite ids:
+
+    plan        {plan id}
+    date        date|{YYYY-MM-DD}
+    activity    date|{YYYY-MM-DD}|activity|{index}
+
+The models use `__slots__` and keep the id parsed into its parts, so
+handlers don't rebuild or re-split ids. `from_doc`/`to_doc` convert to and
+from the stored JSON shape; fields a model doesn't know (`upVoters`, `rev`,
+`draft`, ...) are carried through untouched, in their original order.
+
+Run `python models.py` for memory and serialization benchmarks.
+"""
+import json
+import time
+import tracemalloc
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+DATE_PREFIX = "date|"
+ACTIVITY_SEPARATOR = "|activity|"
+
+
+# Id codec
+
+
+def date_doc_id(date: str) -> str:
+    return DATE_PREFIX + date
+
+
+def activity_doc_id(date: str, index) -> str:
+    return f"{DATE_PREFIX}{date}{ACTIVITY_SEPARATOR}{index}"
+
+
+def activity_prefix(date: str) -> str:
+    """
+    Common prefix of the ids of every activity on `date`.
+    """
+    return DATE_PREFIX + date + ACTIVITY_SEPARATOR
+
+
+def parse_date_id(doc_id: str) -> str:
+    if not doc_id.startswith(DATE_PREFIX) or "|" in doc_id[len(DATE_PREFIX) :]:
+        raise ValueError(f"Not a date id: {doc_id}")
+    return doc_id[len(DATE_PREFIX) :]
+
+
+def parse_activity_id(doc_id: str) -> Tuple[str, str]:
+    """
+    Split an activity id into its date and index.
+    """
+    date, separator, index = doc_id[len(DATE_PREFIX) :].partition(ACTIVITY_SEPARATOR)
+    if not doc_id.startswith(DATE_PREFIX) or not separator or not index:
+        raise ValueError(f"Not an activity id: {doc_id}")
+    return date, index
+
+
+def activity_sort_key(doc_id: str) -> Tuple[str, int]:
+    """
+    Order activities by date, then numerically by index.
+    """
+    date, index = parse_activity_id(doc_id)
+    return date, int(index)
+
+
+# Models
+
+
+class _Doc(ABC):
+    __slots__ = (
+        "plan",
+        "created_by",
+        "created_at",
+        "last_updated_by",
+        "last_updated_at",
+        "extra",
+    )
+
+    TYPE = ""
+
+    def __init__(
+        self,
+        plan: str,
+        created_by: Optional[str],
+        created_at: int,
+        last_updated_by: Optional[str] = None,
+        last_updated_at: Optional[int] = None,
+        extra: Optional[dict] = None,
+    ):
+        self.plan = plan
+        self.created_by = created_by
+        self.created_at = created_at
+        self.last_updated_by = (
+            created_by if last_updated_by is None else last_updated_by
+        )
+        self.last_updated_at = (
+            created_at if last_updated_at is None else last_updated_at
+        )
+        self.extra = extra
+
+    @property
+    @abstractmethod
+    def id(self) -> str:
+        """
+        The document id, built from the model's fields.
+        """
+
+    def touch(self, by: str, at: int) -> None:
+        self.last_updated_by = by
+        self.last_updated_at = at
+
+    def _fields(self) -> dict:
+        return {}
+
+    def to_doc(self) -> dict:
+        doc = {"plan": self.plan, "id": self.id, "type": self.TYPE}
+        doc.update(self._fields())
+        doc["createdBy"] = self.created_by
+        doc["createdAt"] = self.created_at
+        doc["lastUpdatedBy"] = self.last_updated_by
+        doc["lastUpdatedAt"] = self.last_updated_at
+        if self.extra:
+            doc.update(self.extra)
+        return doc
+
+    @staticmethod
+    def _extra(doc, known) -> Optional[dict]:
+        return {k: v for k, v in doc.items() if k not in known} or None
+
+
+_COMMON_KEYS = frozenset(
+    ("plan", "id", "type", "createdBy", "createdAt", "lastUpdatedBy", "lastUpdatedAt")
+)
+
+
+class PlanDoc(_Doc):
+    __slots__ = ("plan_name",)
+
+    TYPE = "plan"
+    KEYS = _COMMON_KEYS | {"planName"}
+
+    def __init__(
+        self, plan: str, plan_name: str, created_by: str, created_at: int, **kwargs
+    ):
+        super().__init__(plan, created_by, created_at, **kwargs)
+        self.plan_name = plan_name
+
+    @property
+    def id(self) -> str:
+        return self.plan
+
+    def _fields(self) -> dict:
+        return {"planName": self.plan_name}
+
+    @classmethod
+    def from_doc(cls, doc) -> "PlanDoc":
+        return cls(
+            doc["plan"],
+            doc.get("planName"),
+            doc.get("createdBy"),
+            doc.get("createdAt"),
+            last_updated_by=doc.get("lastUpdatedBy"),
+            last_updated_at=doc.get("lastUpdatedAt"),
+            extra=cls._extra(doc, cls.KEYS),
+        )
+
+
+class DateDoc(_Doc):
+    __slots__ = ("date",)
+
+    TYPE = "date"
+    KEYS = _COMMON_KEYS
+
+    def __init__(
+        self, plan: str, date: str, created_by: str, created_at: int, **kwargs
+    ):
+        super().__init__(plan, created_by, created_at, **kwargs)
+        self.date = date
+
+    @property
+    def id(self) -> str:
+        return date_doc_id(self.date)
+
+    @classmethod
+    def from_doc(cls, doc) -> "DateDoc":
+        return cls(
+            doc["plan"],
+            parse_date_id(doc["id"]),
+            doc.get("createdBy"),
+            doc.get("createdAt"),
+            last_updated_by=doc.get("lastUpdatedBy"),
+            last_updated_at=doc.get("lastUpdatedAt"),
+            extra=cls._extra(doc, cls.KEYS),
+        )
+
+
+class ActivityDoc(_Doc):
+    __slots__ = ("date", "index", "activity_text")
+
+    TYPE = "activity"
+    KEYS = _COMMON_KEYS | {"activityText"}
+
+    def __init__(
+        self,
+        plan: str,
+        date: str,
+        index,
+        created_by: str,
+        created_at: int,
+        activity_text: str = "",
+        **kwargs,
+    ):
+        super().__init__(plan, created_by, created_at, **kwargs)
+        self.date = date
+        self.index = str(index)
+        self.activity_text = activity_text
+
+    @property
+    def id(self) -> str:
+        return activity_doc_id(self.date, self.index)
+
+    def move_to(self, date: str, index) -> None:
+        self.date = date
+        self.index = str(index)
+
+    def set_fields(self, **fields) -> None:
+        """
+        Set fields the model doesn't know, e.g. `rev` or `upVoters`.
+        """
+        if self.extra is None:
+            self.extra = {}
+        self.extra.update(fields)
+
+    def _fields(self) -> dict:
+        return {"activityText": self.activity_text}
+
+    @classmethod
+    def from_doc(cls, doc) -> "ActivityDoc":
+        date, index = parse_activity_id(doc["id"])
+        return cls(
+            doc["plan"],
+            date,
+            index,
+            doc.get("createdBy"),
+            doc.get("createdAt"),
+            activity_text=doc.get("activityText", ""),
+            last_updated_by=doc.get("lastUpdatedBy"),
+            last_updated_at=doc.get("lastUpdatedAt"),
+            extra=cls._extra(doc, cls.KEYS),
+        )
+
+
+MODELS = {m.TYPE: m for m in (PlanDoc, DateDoc, ActivityDoc)}
+
+
+def from_doc(doc):
+    return MODELS[doc["type"]].from_doc(doc)
+
+
+# Benchmarks
+
+
+def _sample_docs(n_dates: int, per_date: int):
+    docs = []
+    for d in range(n_dates):
+        date = f"2024-{1 + d // 28:02d}-{1 + d % 28:02d}"
+        docs.append(DateDoc("p", date, "alex", 1717000000000).to_doc())
+        for i in range(per_date):
+            activity = ActivityDoc(
+                "p", date, i, "alex", 1717000000000, activity_text="Hike the ridge"
+            )
+            if i % 2:
+                activity.set_fields(upVoters=["sam"], downVoters=[])
+            docs.append(activity.to_doc())
+    return docs
+
+
+def _measure(build) -> Tuple[object, int]:
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+
+def _benchmark(n_dates: int, per_date: int, repeat: int = 3) -> None:
+    raw = json.dumps(_sample_docs(n_dates, per_date))
+    n = n_dates * (per_date + 1)
+
+    dicts, dict_bytes = _measure(lambda: json.loads(raw))
+    models, model_bytes = _measure(lambda: [from_doc(d) for d in json.loads(raw)])
+    del dicts
+
+    def best(fn) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000
+
+    docs = json.loads(raw)
+    activities = [d for d in docs if d["type"] == "activity"]
+    print(f"{n:,} documents ({n_dates} dates x {per_date} activities)")
+    print(f"  memory, dicts:       {dict_bytes / 1024:>10,.0f} KiB")
+    print(f"  memory, models:      {model_bytes / 1024:>10,.0f} KiB")
+    print(
+        f"  from_doc:            {best(lambda: [from_doc(d) for d in docs]):>10.1f} ms"
+    )
+    print(
+        f"  to_doc:              {best(lambda: [m.to_doc() for m in models]):>10.1f} ms"
+    )
+    print(f"  dumps(dicts):        {best(lambda: json.dumps(docs)):>10.1f} ms")
+    print(
+        f"  dumps(models):       "
+        f"{best(lambda: json.dumps([m.to_doc() for m in models])):>10.1f} ms"
+    )
+    print(
+        f"  sort, split('|'):    "
+        f"{best(lambda: sorted(activities, key=lambda x: (x['id'].split('|')[1], int(x['id'].split('|')[3])))):>10.1f} ms"
+    )
+    print(
+        f"  sort, models:        "
+        f"{best(lambda: sorted((m for m in models if m.TYPE == 'activity'), key=lambda m: (m.date, int(m.index)))):>10.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    for n_dates, per_date in ((30, 10), (100, 50), (365, 100)):
+        _benchmark(n_dates, per_date)
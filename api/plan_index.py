@@ -0,0 +1,102 @@
+"""
+Per-plan sets of live date and activity ids, kept warm on the instance.
+
+Existence checks (`lock_activity`, non-final `update_activity`) are answered
+from the set instead of reading the document. A plan's set is loaded with
+one id-only query and then kept current by this instance's own writes;
+writes made on other instances are picked up when a lookup misses and the
+set is older than `REFRESH_AFTER_SECONDS`, so a new id is never reported
+missing for long. Hits are trusted for at most `MAX_AGE_SECONDS`, after
+which the set is reloaded anyway, so an id deleted on another instance is
+reported present for no longer than that.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Set
+
+from storage import query_ids
+
+REFRESH_AFTER_SECONDS = 2
+MAX_AGE_SECONDS = 30
+MAX_PLANS = 1000
+
+
+class _PlanIds:
+    __slots__ = ("ids", "loaded_at")
+
+    def __init__(self, ids: Set[str]):
+        self.ids = ids
+        self.loaded_at = time.monotonic()
+
+
+class PlanIdIndex:
+    def __init__(self, max_plans: int = MAX_PLANS):
+        self.max_plans = max_plans
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def _load(self, plan_id: str) -> _PlanIds:
+        entry = _PlanIds(set(query_ids(plan_id, ("date", "activity"))))
+        with self.lock:
+            self.loads += 1
+            self.plans[plan_id] = entry
+            self.plans.move_to_end(plan_id)
+            while len(self.plans) > self.max_plans:
+                self.plans.popitem(last=False)
+        return entry
+
+    def exists(self, plan_id: str, doc_id: str) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.plans.get(plan_id)
+            if entry is not None and now - entry.loaded_at >= MAX_AGE_SECONDS:
+                entry = None
+            if entry is not None:
+                self.plans.move_to_end(plan_id)
+                if doc_id in entry.ids:
+                    self.hits += 1
+                    return True
+        if entry is None or now - entry.loaded_at >= REFRESH_AFTER_SECONDS:
+            entry = self._load(plan_id)
+        return doc_id in entry.ids
+
+    def seed(self, plan_id: str, ids: Iterable[str]) -> None:
+        """
+        Start a plan's set from ids known to be complete (a new plan).
+        """
+        entry = _PlanIds(set(ids))
+        with self.lock:
+            self.plans[plan_id] = entry
+            while len(self.plans) > self.max_plans:
+                self.plans.popitem(last=False)
+
+    def add(self, plan_id: str, *ids: str) -> None:
+        with self.lock:
+            entry = self.plans.get(plan_id)
+            if entry is not None:
+                entry.ids.update(ids)
+
+    def discard(self, plan_id: str, *ids: str) -> None:
+        with self.lock:
+            entry = self.plans.get(plan_id)
+            if entry is not None:
+                entry.ids.difference_update(ids)
+
+    def forget(self, plan_id: str) -> None:
+        with self.lock:
+            self.plans.pop(plan_id, None)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "plans": len(self.plans),
+                "ids": sum(len(x.ids) for x in self.plans.values()),
+                "hits": self.hits,
+                "loads": self.loads,
+            }
+
+
+plan_ids = PlanIdIndex()
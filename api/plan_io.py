@@ -0,0 +1,158 @@
+"""
+Streaming NDJSON export and bulk import of plan documents.
+
+Usage:
+    python plan_io.py export [--plan PLAN_ID] [-o FILE]
+    python plan_io.py import [-i FILE] [--batch-size N] [--workers N]
+
+The connection string is read from the `CosmosDB` environment variable, the
+same app setting used by the function bindings.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from storage import get_container, strip_system_properties
+
+# Documents marked for deletion (ttl=1) are skipped
+EXPORT_QUERY = "SELECT * FROM c WHERE NOT IS_DEFINED(c.ttl) OR c.ttl != 1"
+
+# Transactional batches are limited to 100 operations on a single partition
+MAX_BATCH_SIZE = 100
+
+
+def iter_plan_documents(container, plan_id: Optional[str] = None) -> Iterator[dict]:
+    """
+    Yield the documents of one plan (or of every plan) page by page.
+    """
+    if plan_id:
+        items = container.query_items(EXPORT_QUERY, partition_key=plan_id)
+    else:
+        items = container.query_items(EXPORT_QUERY, enable_cross_partition_query=True)
+    for item in items:
+        yield strip_system_properties(item)
+
+
+def iter_ndjson(docs: Iterable[dict]) -> Iterator[str]:
+    for doc in docs:
+        yield json.dumps(doc, separators=(",", ":")) + "\n"
+
+
+def iter_ndjson_documents(lines: Iterable[str]) -> Iterator[dict]:
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def import_documents(
+    container,
+    docs: Iterable[dict],
+    batch_size: int = MAX_BATCH_SIZE,
+    workers: int = 8,
+) -> dict:
+    """
+    Upsert documents in per-partition batches on a pool of workers.
+
+    At most `workers * 2` batches are in flight and at most `batch_size *
+    workers * 2` documents wait in partially filled batches; reading from
+    `docs` blocks until a slot frees up, so the input is never buffered past
+    that.
+    """
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    slots = threading.BoundedSemaphore(workers * 2)
+    lock = threading.Lock()
+    stats = {"documents": 0, "batches": 0, "failed": 0}
+    pending = {}
+    max_buffered = batch_size * workers * 2
+    buffered = 0
+
+    def write_batch(partition_key, batch):
+        try:
+            container.execute_item_batch(
+                [("upsert", (doc,)) for doc in batch], partition_key=partition_key
+            )
+            with lock:
+                stats["documents"] += len(batch)
+                stats["batches"] += 1
+        except Exception:
+            logging.exception(f"Failed to import batch for plan '{partition_key}'")
+            with lock:
+                stats["failed"] += len(batch)
+        finally:
+            slots.release()
+
+    def submit(pool, partition_key):
+        nonlocal buffered
+        slots.acquire()
+        batch = pending.pop(partition_key)
+        buffered -= len(batch)
+        pool.submit(write_batch, partition_key, batch)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for doc in docs:
+            partition_key = doc["plan"]
+            pending.setdefault(partition_key, []).append(doc)
+            buffered += 1
+            if len(pending[partition_key]) >= batch_size:
+                submit(pool, partition_key)
+            elif buffered >= max_buffered:
+                # Too many partially filled batches; flush the largest
+                submit(pool, max(pending, key=lambda k: len(pending[k])))
+        for partition_key in list(pending):
+            submit(pool, partition_key)
+
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    return stats
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export or import plans as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Stream plans as NDJSON")
+    export_parser.add_argument("--plan", help="Export a single plan (default: all)")
+    export_parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+
+    import_parser = commands.add_parser("import", help="Bulk upsert NDJSON documents")
+    import_parser.add_argument("-i", "--input", help="Input file (default: stdin)")
+    import_parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE)
+    import_parser.add_argument("--workers", type=int, default=8)
+
+    args = parser.parse_args(argv)
+    container = get_container()
+
+    if args.command == "export":
+        out = open(args.output, "w") if args.output else sys.stdout
+        try:
+            for line in iter_ndjson(iter_plan_documents(container, args.plan)):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return 0
+
+    src = open(args.input) if args.input else sys.stdin
+    try:
+        stats = import_documents(
+            container,
+            iter_ndjson_documents(src),
+            batch_size=args.batch_size,
+            workers=args.workers,
+        )
+    finally:
+        if src is not sys.stdin:
+            src.close()
+    print(json.dumps(stats), file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+Opt-in per-invocation profiling of HTTP functions.
+
+Handlers decorated with `@profiled` run under cProfile when either:
+- the function is listed in the `PROFILE_FUNCTIONS` app setting ("*" for
+  all), sampled at `PROFILE_SAMPLE_RATE` (0-1, default 0.01), or
+- the request carries a valid `X-Profile` header, signed with the
+  `PROFILE_SECRET` app setting (see `sign`); these are always profiled.
+
+Each profiled invocation writes `<function>-<time>-<rand>.prof` (pstats
+format) and a `.json` summary to `PROFILE_DIR` (default: `profiles` in the
+temp directory, the instance's local storage). The summary has wall and CPU
+time, input binding sizes, output binding sizes and timings of the SDK calls
+made through storage.py. Only the newest `PROFILE_MAX_FILES` profiles are
+kept.
+
+Sign a header for an hour of profiling get_plan:
+    PROFILE_SECRET=... python profiling.py sign get_plan --ttl 3600
+"""
+import argparse
+import cProfile
+import functools
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import azure.functions as func
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_FUNCTIONS = {
+    x.strip() for x in os.environ.get("PROFILE_FUNCTIONS", "").split(",") if x.strip()
+}
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.01))
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET", "")
+PROFILE_DIR = os.environ.get(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "profiles")
+)
+MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 200))
+TOP_FUNCTIONS = 25
+
+_active = threading.local()
+
+
+def _signature(function_name: str, expires: int, secret: str) -> str:
+    return hmac.new(
+        secret.encode(), f"{function_name}:{expires}".encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def sign(function_name: str, ttl: int = 3600, secret: str = PROFILE_SECRET) -> str:
+    """
+    Header value that turns on profiling of `function_name` for `ttl` seconds.
+    """
+    expires = int(time.time()) + ttl
+    return f"{expires}:{_signature(function_name, expires, secret)}"
+
+
+def _valid_header(value: Optional[str], function_name: str) -> bool:
+    if not value or not PROFILE_SECRET:
+        return False
+    expires, _, signature = value.partition(":")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(
+        signature, _signature(function_name, int(expires), PROFILE_SECRET)
+    )
+
+
+def should_profile(req: func.HttpRequest, function_name: str) -> bool:
+    if _valid_header(req.headers.get(PROFILE_HEADER), function_name):
+        return True
+    if "*" in PROFILE_FUNCTIONS or function_name in PROFILE_FUNCTIONS:
+        return random.random() < SAMPLE_RATE
+    return False
+
+
+@contextmanager
+def timed(label: str):
+    """
+    Record how long the block took in the current profile, if any.
+    """
+    io_timings = getattr(_active, "io", None)
+    if io_timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        io_timings.append([label, round((time.perf_counter() - start) * 1000, 3)])
+
+
+class _TimedOut:
+    """
+    Wraps an output binding to record when and how much was set.
+    """
+
+    __slots__ = ("out", "name", "record")
+
+    def __init__(self, out, name: str, record: dict):
+        self.out = out
+        self.name = name
+        self.record = record
+
+    def set(self, val) -> None:
+        self.record[self.name] = {
+            "bytes": len(val) if isinstance(val, (str, bytes)) else None,
+            "atMs": round((time.perf_counter() - self.record["_start"]) * 1000, 3),
+        }
+        self.out.set(val)
+
+    def get(self):
+        return self.out.get()
+
+
+def _input_size(value):
+    if isinstance(value, func.DocumentList):
+        return {"documents": len(value)}
+    if isinstance(value, (str, bytes)):
+        return {"bytes": len(value)}
+    return None
+
+
+def _prune(directory: str) -> None:
+    profiles = sorted(
+        (os.path.join(directory, x) for x in os.listdir(directory)),
+        key=os.path.getmtime,
+    )
+    for path in profiles[: max(0, len(profiles) - MAX_FILES * 2)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _write(function_name: str, profiler: cProfile.Profile, summary: dict) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(
+        PROFILE_DIR,
+        f"{function_name}-{int(time.time() * 1000)}-{os.urandom(3).hex()}",
+    )
+    profiler.dump_stats(base + ".prof")
+
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(
+        TOP_FUNCTIONS
+    )
+    summary["top"] = text.getvalue()
+    with open(base + ".json", "w") as f:
+        json.dump(summary, f, indent=2)
+    _prune(PROFILE_DIR)
+    return base
+
+
+def profiled(handler):
+    """
+    Profile a handler's invocations when asked to; otherwise a plain call.
+    """
+    function_name = handler.__name__
+
+    @functools.wraps(handler)
+    def wrapper(req: func.HttpRequest, **kwargs):
+        if getattr(_active, "io", None) is not None or not should_profile(
+            req, function_name
+        ):
+            return handler(req, **kwargs)
+
+        outputs = {"_start": time.perf_counter()}
+        inputs = {}
+        for name, value in kwargs.items():
+            if hasattr(value, "set"):
+                kwargs[name] = _TimedOut(value, name, outputs)
+            else:
+                inputs[name] = _input_size(value)
+
+        _active.io = io_timings = []
+        profiler = cProfile.Profile()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            profiler.enable()
+            response = handler(req, **kwargs)
+        finally:
+            profiler.disable()
+            _active.io = None
+        summary = {
+            "function": function_name,
+            "url": req.url,
+            "routeParams": dict(req.route_params),
+            "status": response.status_code,
+            "wallMs": round((time.perf_counter() - wall_start) * 1000, 3),
+            "cpuMs": round((time.process_time() - cpu_start) * 1000, 3),
+            "inputs": inputs,
+            "outputs": {k: v for k, v in outputs.items() if k != "_start"},
+            "io": io_timings,
+        }
+        try:
+            path = _write(function_name, profiler, summary)
+            logging.info(f"Profiled {function_name} in {summary['wallMs']} ms: {path}")
+        except Exception:
+            logging.exception(f"Failed to write profile of {function_name}")
+        return response
+
+    return wrapper
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Profiling helpers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sign_cmd = commands.add_parser("sign", help=f"Make a {PROFILE_HEADER} header")
+    sign_cmd.add_argument("function")
+    sign_cmd.add_argument("--ttl", type=int, default=3600)
+    args = parser.parse_args(argv)
+
+    if not PROFILE_SECRET:
+        raise SystemExit("Set PROFILE_SECRET to the app's setting")
+    print(f"{PROFILE_HEADER}: {sign(args.function, args.ttl)}")
+
+
+if __name__ == "__main__":
+    main()
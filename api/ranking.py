@@ -0,0 +1,212 @@
+"""
+Per-plan vote ranking, kept in a single `ranking` document:
+
+    {"plan": ..., "id": "ranking", "type": "ranking", "lastUpdatedAt": <ms>,
+     "dates": {"2024-01-01": [{"id": "2", "score": 3, "up": 4, "down": 1}, ...]}}
+
+Each date's entries are ordered best first (highest score, then lowest
+activity index). Handlers change it through `update_ranking`, which writes
+only if the document is unchanged since it was read (etag) and otherwise
+reads and applies the change again, so concurrent votes don't overwrite
+each other's entries. A plan without the document (e.g. one created before
+rankings were kept) gets it built from its activities' votes first.
+"""
+import logging
+import time
+from typing import Callable, List, Optional
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+from models import parse_activity_id
+from storage import get_container, query_documents, strip_system_properties
+
+RANKING_ID = "ranking"
+# Conditional writes tried before giving up; the ranking is then left to the
+# next change
+MAX_ATTEMPTS = 5
+
+ACTIVITY_VOTES_QUERY = (
+    "SELECT c.id, c.upVoters, c.downVoters FROM c WHERE c.type='activity'"
+)
+
+
+def empty_ranking(plan_id: str) -> dict:
+    return {
+        "plan": plan_id,
+        "id": RANKING_ID,
+        "type": "ranking",
+        "lastUpdatedAt": 0,
+        "dates": {},
+    }
+
+
+def load_ranking(plan_id: str, rankingDoc) -> dict:
+    """
+    Get the ranking from its input binding, or an empty one.
+    """
+    if not rankingDoc:
+        return empty_ranking(plan_id)
+    return strip_system_properties(dict(rankingDoc[0]))
+
+
+def backfill_ranking(plan_id: str) -> dict:
+    """
+    Build a plan's ranking from the votes on its activities.
+    """
+    ranking = empty_ranking(plan_id)
+    for doc in query_documents(plan_id, ACTIVITY_VOTES_QUERY):
+        date_id, activity_id = parse_activity_id(doc["id"])
+        set_votes(
+            ranking,
+            date_id,
+            activity_id,
+            doc.get("upVoters") or [],
+            doc.get("downVoters") or [],
+        )
+    return ranking
+
+
+def update_ranking(plan_id: str, change: Callable[[dict], bool]) -> Optional[dict]:
+    """
+    Apply `change` (e.g. `lambda r: remove(r, date_id)`, returning whether
+    it changed anything) to the stored ranking, backfilling it if missing.
+    Returns the new ranking, or None if nothing changed or the write kept
+    conflicting.
+    """
+    container = get_container()
+    for _ in range(MAX_ATTEMPTS):
+        try:
+            item = container.read_item(RANKING_ID, partition_key=plan_id)
+        except CosmosResourceNotFoundError:
+            item = None
+        ranking = strip_system_properties(item) if item else backfill_ranking(plan_id)
+        # A backfilled ranking is worth writing even if `change` is a no-op
+        if not change(ranking) and (item or not ranking["dates"]):
+            return None
+        try:
+            if item:
+                container.replace_item(
+                    RANKING_ID,
+                    ranking,
+                    etag=item["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            else:
+                container.create_item(ranking)
+        except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+            # Someone else wrote it first; start over from their version
+            continue
+        return ranking
+    logging.warning(f"Gave up updating the ranking of plan {plan_id}")
+    return None
+
+
+def _sort_key(entry: dict):
+    return (-entry["score"], int(entry["id"]))
+
+
+def _insert(entries: List[dict], entry: dict) -> None:
+    # Entries are already ordered, so only the new one needs placing
+    key = _sort_key(entry)
+    lo, hi = 0, len(entries)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _sort_key(entries[mid]) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    entries.insert(lo, entry)
+
+
+def _pop(entries: List[dict], activity_id: str) -> Optional[dict]:
+    for i, entry in enumerate(entries):
+        if entry["id"] == activity_id:
+            return entries.pop(i)
+    return None
+
+
+def _touch(ranking: dict) -> None:
+    ranking["lastUpdatedAt"] = int(time.time() * 1000)
+
+
+def set_votes(
+    ranking: dict, date_id: str, activity_id: str, up_voters: list, down_voters: list
+) -> bool:
+    """
+    Update an activity's score. Returns whether the date's ranking changed.
+    """
+    entries = ranking["dates"].setdefault(date_id, [])
+    previous = _pop(entries, str(activity_id))
+    entry = {
+        "id": str(activity_id),
+        "score": len(up_voters) - len(down_voters),
+        "up": len(up_voters),
+        "down": len(down_voters),
+    }
+    if entry["up"] or entry["down"]:
+        _insert(entries, entry)
+    if not entries:
+        del ranking["dates"][date_id]
+    if previous == entry:
+        return False
+    _touch(ranking)
+    return True
+
+
+def remove(ranking: dict, date_id: str, activity_id: Optional[str] = None) -> bool:
+    """
+    Drop one activity (or a whole date). Returns whether anything was removed.
+    """
+    entries = ranking["dates"].get(date_id)
+    if not entries:
+        return False
+    if activity_id is None:
+        del ranking["dates"][date_id]
+    else:
+        if _pop(entries, str(activity_id)) is None:
+            return False
+        if not entries:
+            del ranking["dates"][date_id]
+    _touch(ranking)
+    return True
+
+
+def move(
+    ranking: dict,
+    date_id: str,
+    activity_id: str,
+    new_date_id: str,
+    new_activity_id: str,
+) -> bool:
+    """
+    Carry an activity's entry over to its new id.
+    """
+    entries = ranking["dates"].get(date_id)
+    entry = _pop(entries, str(activity_id)) if entries else None
+    if entry is None:
+        return False
+    if not entries:
+        del ranking["dates"][date_id]
+    entry["id"] = str(new_activity_id)
+    _insert(ranking["dates"].setdefault(new_date_id, []), entry)
+    _touch(ranking)
+    return True
+
+
+def ranking_message(plan_id: str, ranking: dict, date_ids: List[str]) -> dict:
+    """
+    Build the SignalR message announcing the new ranking of some dates.
+    """
+    return {
+        "target": "rankingUpdated",
+        "arguments": [
+            {"dateId": date_id, "ranking": ranking["dates"].get(date_id, [])}
+            for date_id in date_ids
+        ],
+        "groupName": plan_id,
+    }
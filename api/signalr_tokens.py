@@ -0,0 +1,159 @@
+"""
+Negotiate without the `signalRConnectionInfo` binding: client access tokens
+for Azure SignalR are minted in-process from the connection string.
+
+A token is an HS256 JWT signed with the connection string's AccessKey, for
+the audience `{endpoint}/client/?hub={hub}`. The key and the HMAC state
+seeded with it are prepared once per process, so minting is a couple of
+base64 encodings and one digest. Tokens are bound to a user (`nameid`) when
+the request names one, and live `SIGNALR_TOKEN_LIFETIME_MINUTES` (app
+setting, default 60).
+
+Run `python signalr_tokens.py` for a negotiate throughput benchmark under a
+connection burst.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+import azure.functions as func
+
+from constants import SIGNALR_CONN_STRING, SIGNALR_HUB_NAME
+
+TOKEN_LIFETIME_SECONDS = int(os.environ.get("SIGNALR_TOKEN_LIFETIME_MINUTES", 60)) * 60
+USER_ID_HEADER = "x-ms-signalr-userid"
+
+# Set when clients should connect to a hub served by this process (asgi.py)
+_local_hub_path: Optional[str] = None
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+_HEADER = _b64(json.dumps({"alg": "HS256", "typ": "JWT"}).encode())
+
+
+class TokenMinter:
+    """
+    Client URL and token factory for one hub of one Azure SignalR resource.
+    """
+
+    __slots__ = ("url", "signer")
+
+    def __init__(self, connection_string: str, hub: str):
+        settings = dict(
+            x.split("=", 1) for x in connection_string.split(";") if "=" in x
+        )
+        endpoint = settings.get("ClientEndpoint") or settings["Endpoint"]
+        endpoint = endpoint.rstrip("/")
+        if "Port" in settings and "ClientEndpoint" not in settings:
+            endpoint = f"{endpoint}:{settings['Port']}"
+        self.url = f"{endpoint}/client/?hub={hub.lower()}"
+        # Copied per token, so the key schedule is only computed once
+        self.signer = hmac.new(settings["AccessKey"].encode(), digestmod=hashlib.sha256)
+
+    def mint(
+        self, user_id: Optional[str] = None, lifetime: int = TOKEN_LIFETIME_SECONDS
+    ) -> str:
+        now = int(time.time())
+        claims = {"aud": self.url, "iat": now, "exp": now + lifetime}
+        if user_id:
+            claims["nameid"] = user_id
+        signing_input = (
+            f"{_HEADER}.{_b64(json.dumps(claims, separators=(',', ':')).encode())}"
+        )
+        signer = self.signer.copy()
+        signer.update(signing_input.encode("ascii"))
+        return f"{signing_input}.{_b64(signer.digest())}"
+
+
+@lru_cache(maxsize=None)
+def get_minter(
+    conn_setting: str = SIGNALR_CONN_STRING, hub: str = SIGNALR_HUB_NAME
+) -> TokenMinter:
+    return TokenMinter(os.environ[conn_setting], hub)
+
+
+def use_local_hub(path: str) -> None:
+    """
+    Point clients at a hub served by this process at `path` (no token).
+    """
+    global _local_hub_path
+    _local_hub_path = path
+
+
+def user_id(req: func.HttpRequest) -> Optional[str]:
+    return req.headers.get(USER_ID_HEADER) or req.params.get("userId") or None
+
+
+def connection_info(req: func.HttpRequest) -> dict:
+    """
+    What `negotiate` returns: the hub URL and an access token for it.
+    """
+    if _local_hub_path is not None:
+        base = req.url.split("/api/", 1)[0]
+        return {"url": base + _local_hub_path, "accessToken": ""}
+    if os.environ.get("SIGNALR_HUB_URL"):
+        # A self-hosted hub elsewhere, which doesn't check tokens
+        return {"url": os.environ["SIGNALR_HUB_URL"], "accessToken": ""}
+    minter = get_minter()
+    return {"url": minter.url, "accessToken": minter.mint(user_id(req))}
+
+
+def _benchmark(clients: int = 5000, threads: int = 16) -> None:
+    """
+    Negotiate for a burst of clients connecting at once.
+    """
+    import function_app
+    from asgi import iter_functions
+
+    os.environ.setdefault(
+        SIGNALR_CONN_STRING,
+        "Endpoint=https://bench.service.signalr.net;"
+        "AccessKey=" + _b64(os.urandom(32)) + ";Version=1.0;",
+    )
+    negotiate = next(
+        f.get_user_function()
+        for f in iter_functions(function_app)
+        if f.get_function_name() == "negotiate"
+    )
+    requests = [
+        func.HttpRequest(
+            "POST",
+            "/api/negotiate",
+            headers={USER_ID_HEADER: f"user{i}"},
+            body=b"",
+        )
+        for i in range(clients)
+    ]
+
+    start = time.perf_counter()
+    for _ in range(clients):
+        get_minter().mint("user")
+    mint_seconds = time.perf_counter() - start
+
+    for workers in (1, threads):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            responses = list(pool.map(negotiate, requests))
+        seconds = time.perf_counter() - start
+        assert all(r.status_code == 200 for r in responses)
+        print(
+            f"{clients} negotiates, {workers:>2} threads: {seconds * 1000:8.1f} ms "
+            f"({clients / seconds:,.0f}/s)"
+        )
+    print(
+        f"{clients} mints alone:           {mint_seconds * 1000:8.1f} ms "
+        f"({clients / mint_seconds:,.0f}/s)"
+    )
+
+
+if __name__ == "__main__":
+    _benchmark()
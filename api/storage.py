@@ -0,0 +1,105 @@
+import os
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+
+from azure.cosmos import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+from constants import COSMOS_CONN_STRING, COSMOS_CONTAINER_NAME, COSMOS_DB_NAME
+from profiling import timed
+
+# Cosmos system properties; not part of our documents and rejected on re-import
+SYSTEM_PROPERTIES = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+
+@lru_cache(maxsize=None)
+def get_container(
+    conn_setting: str = COSMOS_CONN_STRING,
+    database_name: str = COSMOS_DB_NAME,
+    container_name: str = COSMOS_CONTAINER_NAME,
+):
+    """
+    Get a (cached) container client for work the function bindings can't express.
+    """
+    client = CosmosClient.from_connection_string(os.environ[conn_setting])
+    return client.get_database_client(database_name).get_container_client(
+        container_name
+    )
+
+
+def strip_system_properties(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if k not in SYSTEM_PROPERTIES}
+
+
+def query_plan_documents(plan_id: str, doc_types=("plan", "date", "activity")) -> dict:
+    """
+    Get the live documents of a plan keyed by id.
+    """
+    types = ", ".join(f"'{x}'" for x in doc_types)
+    with timed("query_plan_documents"):
+        items = get_container().query_items(
+            f"SELECT * FROM c WHERE c.type IN ({types}) "
+            "AND (NOT IS_DEFINED(c.ttl) OR c.ttl != 1)",
+            partition_key=plan_id,
+        )
+        return {item["id"]: strip_system_properties(item) for item in items}
+
+
+def query_ids(plan_id: str, doc_types: Tuple[str, ...]) -> List[str]:
+    """
+    Get the ids of a plan's live documents of some types, without the documents.
+    """
+    types = ", ".join(f"'{x}'" for x in doc_types)
+    with timed("query_ids"):
+        return list(
+            get_container().query_items(
+                f"SELECT VALUE c.id FROM c WHERE c.type IN ({types}) "
+                "AND (NOT IS_DEFINED(c.ttl) OR c.ttl != 1)",
+                partition_key=plan_id,
+            )
+        )
+
+
+def read_document(plan_id: str, doc_id: str) -> Optional[dict]:
+    try:
+        with timed(f"read_document {doc_id}"):
+            item = get_container().read_item(doc_id, partition_key=plan_id)
+    except CosmosResourceNotFoundError:
+        return None
+    return strip_system_properties(item)
+
+
+def query_documents(
+    plan_id: str, query: str, parameters: Optional[List[dict]] = None
+) -> Iterator[dict]:
+    with timed("query_documents"):
+        items = get_container().query_items(
+            query, parameters=parameters, partition_key=plan_id
+        )
+        for item in items:
+            yield strip_system_properties(item)
+
+
+def query_page(
+    partition_key: str,
+    query: str,
+    page_size: int,
+    continuation_token: Optional[str] = None,
+    parameters: Optional[List[dict]] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Get one page of a single-partition query and the token for the next one.
+    """
+    pages = (
+        get_container()
+        .query_items(
+            query,
+            parameters=parameters,
+            partition_key=partition_key,
+            max_item_count=page_size,
+        )
+        .by_page(continuation_token)
+    )
+    with timed("query_page"):
+        items = [strip_system_properties(item) for item in next(pages, [])]
+    return items, pages.continuation_token
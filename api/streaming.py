@@ -0,0 +1,198 @@
+"""
+Incrementally encoded, compressed responses for large payloads (getPlan).
+
+`data_response` writes the payload one document at a time: dicts and lists
+are encoded member by member, and generators can stand in for lists, so the
+whole JSON text never exists at once. The text is compressed as it is
+produced, with brotli or gzip as the request's `Accept-Encoding` allows
+(brotli needs the `brotli` package). Under the Functions host the compressed
+chunks are joined into the body; `asgi.py` sends them as they come.
+
+MessagePack responses (see wire.py) are encoded whole, then compressed the
+same way.
+
+Run `python streaming.py` to check that bodies of several MB, in one chunk
+or many, decode back to the original in every supported encoding.
+"""
+import gzip
+import json
+import os
+import zlib
+from collections.abc import Iterator as IteratorType
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+import azure.functions as func
+
+from wire import JSON_MIMETYPE, MSGPACK_MIMETYPE, msgpack, wants_msgpack
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Text handed to the compressor at a time; each chunk is flushed, so a
+# streaming server can send it right away
+CHUNK_SIZE = 64 * 1024
+# List items encoded per json.dumps call
+BATCH_SIZE = 100
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+
+def choose_encoding(req: func.HttpRequest) -> Optional[str]:
+    """
+    The supported encoding the client prefers, by `q` and then ours.
+    """
+    accepted = {}
+    for part in (req.headers.get("Accept-Encoding") or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = q
+    wildcard = accepted.get("*", 0)
+    candidates = [(accepted.get(x, wildcard), x) for x in ENCODINGS]
+    candidates = [x for x in candidates if x[0] > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda x: (x[0], -ENCODINGS.index(x[1])))[1]
+
+
+def iter_json(value) -> Iterator[str]:
+    """
+    JSON text of `value` in pieces. Dicts, lists and iterators (written as
+    lists) are split up; anything else, e.g. each document, is one piece.
+    """
+    if isinstance(value, dict):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            yield f"{', ' if i else ''}{json.dumps(key)}: "
+            yield from iter_json(item)
+        yield "}"
+    elif isinstance(value, (list, tuple, IteratorType)):
+        # Items are encoded a batch at a time, which costs far less than one
+        # call each and holds no more than a batch of text
+        yield "["
+        items = iter(value)
+        separator = ""
+        while True:
+            batch = list(islice(items, BATCH_SIZE))
+            if not batch:
+                break
+            yield separator + json.dumps(batch)[1:-1]
+            separator = ", "
+        yield "]"
+    else:
+        yield json.dumps(value)
+
+
+def chunked(pieces: Iterable[str], size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield "".join(buffer).encode()
+            buffer.clear()
+            buffered = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def compress(chunks: Iterable[bytes], encoding: Optional[str]) -> Iterator[bytes]:
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            # process() returns output too once its input passes the window
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+    # wbits 31: gzip container
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+class StreamingHttpResponse(func.HttpResponse):
+    """
+    A response whose body is produced by an iterator of byte chunks, consumed
+    either by `iter_body` (streaming) or whole by `get_body`.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], **kwargs):
+        super().__init__(None, **kwargs)
+        self._chunks = iter(chunks)
+        self._body: Optional[bytes] = None
+
+    def iter_body(self) -> Iterator[bytes]:
+        if self._body is not None:
+            yield self._body
+            return
+        for chunk in self._chunks:
+            if chunk:
+                yield chunk
+
+    def get_body(self) -> bytes:
+        if self._body is None:
+            self._body = b"".join(self._chunks)
+        return self._body
+
+
+def data_response(
+    payload: dict, req: func.HttpRequest, status_code: int = 200
+) -> func.HttpResponse:
+    """
+    `payload` encoded and compressed as the request asked for. Generators in
+    it are only consumed as the body is.
+    """
+    encoding = choose_encoding(req)
+    if wants_msgpack(req):
+        mimetype = MSGPACK_MIMETYPE
+        chunks = iter([msgpack.packb(payload, default=list)])
+    else:
+        mimetype = JSON_MIMETYPE
+        chunks = chunked(iter_json(payload))
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return StreamingHttpResponse(
+        compress(chunks, encoding),
+        status_code=status_code,
+        mimetype=mimetype,
+        headers=headers,
+    )
+
+
+def _check_round_trip(size: int = 9 * 1024 * 1024) -> None:
+    """
+    Compress a large body whole (as MessagePack responses are) and in
+    CHUNK_SIZE pieces, and check each decodes back to the original.
+    """
+    # Half incompressible, half repetitive, like documents with ids and text
+    body = os.urandom(size // 2) + b"Hike the ridge, lunch at the hut. " * (size // 68)
+    pieces = [body[i : i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    decoders = {"gzip": gzip.decompress}
+    if brotli:
+        decoders["br"] = brotli.decompress
+    for encoding, decode in decoders.items():
+        for name, chunks in (("one chunk", [body]), ("chunked", pieces)):
+            compressed = b"".join(compress(iter(chunks), encoding))
+            assert decode(compressed) == body, f"{encoding}, {name}"
+            print(
+                f"{encoding:<5} {name:<10} {len(body):>10,} -> {len(compressed):>10,} bytes"
+            )
+
+
+if __name__ == "__main__":
+    _check_round_trip()
@@ -0,0 +1,486 @@
+"""
+Operation-based collaborative editing of `activityText`.
+
+Clients send the edits they made against a revision instead of the whole
+text; each edit is a list of components applied in order:
+
+    {"p": 4, "i": "abc"}   insert "abc" at position 4
+    {"p": 2, "d": 3}       delete 3 characters starting at position 2
+
+Positions count Unicode code points. Edits made against an older revision
+are transformed against everything applied since (concurrent inserts at the
+same position are ordered by user name), so every client converges on the
+same text.
+
+Revisions are numbered in storage, not per instance: each one is a
+`textRev` document (`rev|<activity id>|<createdAt>|<rev>`) created only if
+that id is still free. An instance whose create conflicts has been
+overtaken by another one; it catches up from the stored revisions and
+transforms the edit again. Each instance keeps the text and recent history
+of the activities it serves, seeded from the activity document and the
+stored revisions the first time. An edit older than that history (or still
+conflicting after `MAX_ATTEMPTS`) is rejected with the current text and
+revision, and the client rebases.
+
+Most revisions store only their ops; the text is rebuilt by applying them
+to an earlier revision that carries it. Whole-text resets, every
+`CHECKPOINT_EVERY`th revision and the first one an instance writes without
+knowing where the text was last stored carry the text. An ops-only revision
+expires together with the last one carrying the text before it, so any run
+of revisions still stored can be rebuilt.
+
+Run `python text_ops.py` for a bandwidth comparison with full-text updates
+and a convergence check of concurrent edits.
+"""
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from azure.cosmos.exceptions import CosmosResourceExistsError
+
+from storage import get_container, query_documents
+
+MAX_HISTORY = 200
+MAX_DOCUMENTS = 2000
+MAX_ATTEMPTS = 5
+# Stored revisions are only needed until instances have caught up
+REV_TTL_SECONDS = 24 * 3600
+# At most MAX_HISTORY / 2, so each page of stored revisions carries the text
+CHECKPOINT_EVERY = 100
+# Allows for clock differences between instances and Cosmos
+TTL_MARGIN_SECONDS = 60
+
+REVISIONS_QUERY = (
+    "SELECT TOP @count * FROM c WHERE c.type='textRev' AND c.key=@key "
+    "AND c.rev > @rev ORDER BY c.rev DESC"
+)
+
+
+class StaleRevisionError(Exception):
+    pass
+
+
+def validate_ops(ops) -> List[dict]:
+    """
+    Check the shape of an edit, raising ValueError if it is malformed.
+    """
+    if not isinstance(ops, list):
+        raise ValueError("ops must be a list")
+    for op in ops:
+        if not isinstance(op, dict) or not isinstance(op.get("p"), int) or op["p"] < 0:
+            raise ValueError(f"Invalid op: {op}")
+        if isinstance(op.get("i"), str) and "d" not in op:
+            continue
+        if isinstance(op.get("d"), int) and op["d"] > 0 and "i" not in op:
+            continue
+        raise ValueError(f"Invalid op: {op}")
+    return ops
+
+
+def apply(text: str, ops: List[dict]) -> str:
+    for op in ops:
+        if op["p"] > len(text):
+            raise ValueError(f"Op out of range: {op}")
+        if "i" in op:
+            text = text[: op["p"]] + op["i"] + text[op["p"] :]
+        else:
+            text = text[: op["p"]] + text[op["p"] + op["d"] :]
+    return text
+
+
+def _transform_one(op: dict, other: dict, op_first: bool) -> List[dict]:
+    """
+    Rewrite `op` to apply after `other`; `op_first` breaks insert ties.
+    """
+    p = op["p"]
+    if "i" in other:
+        if "i" in op:
+            if other["p"] < p or (other["p"] == p and not op_first):
+                return [{"p": p + len(other["i"]), "i": op["i"]}]
+            return [op]
+        end = p + op["d"]
+        if other["p"] >= end:
+            return [op]
+        if other["p"] <= p:
+            return [{"p": p + len(other["i"]), "d": op["d"]}]
+        # Insert landed inside the deleted range; keep it
+        head = other["p"] - p
+        return [{"p": p, "d": head}, {"p": p + len(other["i"]), "d": op["d"] - head}]
+
+    other_end = other["p"] + other["d"]
+    if "i" in op:
+        if p <= other["p"]:
+            return [op]
+        if p >= other_end:
+            return [{"p": p - other["d"], "i": op["i"]}]
+        return [{"p": other["p"], "i": op["i"]}]
+    end = p + op["d"]
+    if end <= other["p"]:
+        return [op]
+    if p >= other_end:
+        return [{"p": p - other["d"], "d": op["d"]}]
+    overlap = min(end, other_end) - max(p, other["p"])
+    remaining = op["d"] - overlap
+    return [{"p": min(p, other["p"]), "d": remaining}] if remaining else []
+
+
+def _transform_lists(
+    ops: List[dict], others: List[dict], op_first: bool
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Transform two edits made against the same text past each other.
+    """
+    if not ops or not others:
+        return ops, others
+    if len(ops) == 1 and len(others) == 1:
+        return (
+            _transform_one(ops[0], others[0], op_first),
+            _transform_one(others[0], ops[0], not op_first),
+        )
+    if len(ops) > 1:
+        head, others = _transform_lists(ops[:1], others, op_first)
+        tail, others = _transform_lists(ops[1:], others, op_first)
+        return head + tail, others
+    ops, head = _transform_lists(ops, others[:1], op_first)
+    ops, tail = _transform_lists(ops, others[1:], op_first)
+    return ops, head + tail
+
+
+def transform(
+    ops: List[dict], by: str, applied: List[dict], applied_by: str
+) -> List[dict]:
+    """
+    Rewrite `ops` (by user `by`) to apply after `applied` (by `applied_by`).
+    """
+    return _transform_lists(ops, applied, by < applied_by)[0]
+
+
+class TextState:
+    """
+    Current text, revision and recent history of one activity. States with
+    a `plan` record their revisions in its partition (see `revision_doc`);
+    without one they are local, e.g. for benchmarks.
+    """
+
+    __slots__ = ("text", "rev", "history", "lock", "plan", "key", "base_ts")
+
+    def __init__(self, text: str, rev: int, plan: Optional[str] = None, key: str = ""):
+        self.text = text
+        self.rev = rev
+        # (revision produced, author, ops)
+        self.history = []
+        self.lock = threading.Lock()
+        self.plan = plan
+        self.key = key
+        # Cosmos `_ts` of the last stored revision carrying the text; None
+        # when the text came from elsewhere (the activity document)
+        self.base_ts = None
+
+    def _ops_ttl(self, rev: int) -> Optional[int]:
+        """
+        TTL of revision `rev` stored as ops only, or None if it should carry
+        the text. It must not outlive the revision the text is rebuilt from.
+        """
+        if self.base_ts is None or rev % CHECKPOINT_EVERY == 0:
+            return None
+        age = int(time.time()) - self.base_ts
+        ttl = REV_TTL_SECONDS - age - TTL_MARGIN_SECONDS
+        return ttl if ttl >= REV_TTL_SECONDS // 2 else None
+
+    def _record(self, rev: int, by: str, ops: Optional[List[dict]], text: str) -> bool:
+        """
+        Store revision `rev`; False if another instance stored it first.
+        """
+        if self.plan is None:
+            return True
+        ttl = None if ops is None else self._ops_ttl(rev)
+        if ttl is None:
+            doc = revision_doc(self, rev, by, ops, text)
+        else:
+            doc = revision_doc(self, rev, by, ops, None, ttl)
+        try:
+            created = get_container().create_item(doc)
+        except CosmosResourceExistsError:
+            return False
+        if ttl is None:
+            self.base_ts = (created or {}).get("_ts", int(time.time()))
+        return True
+
+    def catch_up(self, revisions: Optional[Iterable[dict]] = None) -> None:
+        """
+        Apply the revisions stored since ours (read unless given), oldest first.
+        """
+        if revisions is None:
+            revisions = stored_revisions(self)
+        for doc in revisions:
+            if doc["rev"] <= self.rev:
+                continue
+            if doc["rev"] == self.rev + 1 and doc.get("ops") is not None:
+                self.history.append((doc["rev"], doc["by"], doc["ops"]))
+                if "text" in doc:
+                    self.text = doc["text"]
+                else:
+                    self.text = apply(self.text, doc["ops"])
+            elif "text" in doc:
+                # A gap (expired or unread revisions) or a whole-text reset:
+                # older edits can no longer be transformed
+                self.history.clear()
+                self.text = doc["text"]
+            else:
+                # Can't be rebuilt past a gap; a later revision carries the text
+                continue
+            if "text" in doc:
+                self.base_ts = doc.get("_ts")
+            self.rev = doc["rev"]
+        del self.history[:-MAX_HISTORY]
+
+    def submit(
+        self, ops: List[dict], base_rev: int, by: str
+    ) -> Tuple[List[dict], int, str]:
+        """
+        Apply an edit made against `base_rev`; returns the ops as applied, the
+        new revision and the new text.
+        """
+        with self.lock:
+            for _ in range(MAX_ATTEMPTS):
+                if base_rev > self.rev:
+                    self.catch_up()
+                if base_rev > self.rev:
+                    raise StaleRevisionError(f"Unknown revision {base_rev}")
+                missed = self.rev - base_rev
+                if missed > len(self.history):
+                    raise StaleRevisionError(f"Revision {base_rev} is too old")
+                applied = ops
+                for _, applied_by, other in self.history[len(self.history) - missed :]:
+                    applied = transform(applied, by, other, applied_by)
+                text = apply(self.text, applied)
+
+                if self._record(self.rev + 1, by, applied, text):
+                    self.text = text
+                    self.rev += 1
+                    self.history.append((self.rev, by, applied))
+                    del self.history[:-MAX_HISTORY]
+                    return applied, self.rev, self.text
+                self.catch_up()
+            raise StaleRevisionError(f"Revision {self.rev + 1} is taken")
+
+    def reset(self, text: str, by: str) -> int:
+        """
+        Replace the whole text (a full-text update); returns the new revision.
+        """
+        with self.lock:
+            for _ in range(MAX_ATTEMPTS):
+                if self._record(self.rev + 1, by, None, text):
+                    self.text = text
+                    self.rev += 1
+                    self.history.clear()
+                    return self.rev
+                self.catch_up()
+            raise StaleRevisionError(f"Revision {self.rev + 1} is taken")
+
+
+def revision_doc(
+    state: TextState,
+    rev: int,
+    by: str,
+    ops: Optional[List[dict]],
+    text: Optional[str],
+    ttl: int = REV_TTL_SECONDS,
+) -> dict:
+    doc = {
+        "plan": state.plan,
+        "id": f"rev|{state.key}|{rev:010d}",
+        "type": "textRev",
+        "key": state.key,
+        "rev": rev,
+        "by": by,
+        "at": int(time.time() * 1000),
+        "ttl": ttl,
+    }
+    if ops is not None:
+        doc["ops"] = ops
+    if text is not None:
+        doc["text"] = text
+    return doc
+
+
+def stored_revisions(state: TextState) -> List[dict]:
+    """
+    The latest stored revisions after the state's, oldest first.
+    """
+    revisions = query_documents(
+        state.plan,
+        REVISIONS_QUERY,
+        [
+            {"name": "@count", "value": MAX_HISTORY},
+            {"name": "@key", "value": state.key},
+            {"name": "@rev", "value": state.rev},
+        ],
+    )
+    return list(revisions)[::-1]
+
+
+_states = OrderedDict()
+_states_lock = threading.Lock()
+
+
+def get_text_state(
+    plan_id: str, activity_id: str, read: Callable[[], Optional[dict]]
+) -> Optional[TextState]:
+    """
+    Get the instance's state for an activity. Only an activity the instance
+    hasn't seen is read (`read()` returns its document, or None if it is
+    gone) and caught up with the stored revisions.
+    """
+    cache_key = f"{plan_id}|{activity_id}"
+    with _states_lock:
+        state = _states.get(cache_key)
+        if state is not None:
+            _states.move_to_end(cache_key)
+            return state
+
+    doc = read()
+    if doc is None:
+        return None
+    seeded = TextState(
+        doc.get("activityText", ""),
+        doc.get("rev", 0),
+        plan_id,
+        f"{activity_id}|{doc.get('createdAt')}",
+    )
+    seeded.catch_up()
+    with _states_lock:
+        # Another request may have seeded it meanwhile
+        state = _states.setdefault(cache_key, seeded)
+        _states.move_to_end(cache_key)
+        while len(_states) > MAX_DOCUMENTS:
+            _states.popitem(last=False)
+        return state
+
+
+def forget_text_state(plan_id: str, activity_id: str) -> Optional[TextState]:
+    with _states_lock:
+        return _states.pop(f"{plan_id}|{activity_id}", None)
+
+
+def _bandwidth_comparison(length: int = 2000) -> None:
+    """
+    Simulate typing a long description one keystroke at a time, comparing the
+    bytes broadcast per keystroke with full-text and op-based updates.
+    """
+    sample = "Morning hike to the ridge, picnic lunch, then kayaking. "
+    target = (sample * (length // len(sample) + 1))[:length]
+    common = {"id": "3", "dateId": "2024-06-01", "isFinal": False, "byUser": "alex"}
+
+    full_bytes = op_bytes = 0
+    state = TextState("", 0)
+    for i, char in enumerate(target):
+        full = dict(common, activityText=target[: i + 1])
+        ops, rev, _ = state.submit([{"p": i, "i": char}], i, "alex")
+        delta = dict(common, ops=ops, rev=rev)
+        full_bytes += len(json.dumps(full).encode())
+        op_bytes += len(json.dumps(delta).encode())
+
+    assert state.text == target
+    print(f"{length} keystrokes")
+    print(
+        f"  full text: {full_bytes:>12,} bytes ({full_bytes / length:,.0f}/keystroke)"
+    )
+    print(f"  ops:       {op_bytes:>12,} bytes ({op_bytes / length:,.0f}/keystroke)")
+    print(f"  ratio:     {full_bytes / op_bytes:>12,.1f}x")
+
+
+def _random_ops(rng: random.Random, text: str) -> List[dict]:
+    ops = []
+    for _ in range(rng.randint(1, 3)):
+        if text and rng.random() < 0.4:
+            p = rng.randrange(len(text))
+            op = {"p": p, "d": rng.randint(1, min(3, len(text) - p))}
+        else:
+            chars = "".join(rng.choice("xyz\u00e9") for _ in range(rng.randint(1, 3)))
+            op = {"p": rng.randint(0, len(text)), "i": chars}
+        ops.append(op)
+        text = apply(text, [op])
+    return ops
+
+
+class _RevisionStore:
+    """
+    In-memory stand-in for the revisions in a plan's partition.
+    """
+
+    def __init__(self):
+        self.docs = {}
+
+    def create_item(self, body):
+        if body["id"] in self.docs:
+            raise CosmosResourceExistsError(message="Conflict")
+        self.docs[body["id"]] = dict(body, _ts=int(time.time()))
+        return self.docs[body["id"]]
+
+    def query(self, plan_id, query, parameters):
+        values = {p["name"]: p["value"] for p in parameters}
+        found = [
+            doc
+            for doc in self.docs.values()
+            if doc["key"] == values["@key"] and doc["rev"] > values["@rev"]
+        ]
+        found.sort(key=lambda doc: -doc["rev"])
+        return found[: values["@count"]]
+
+
+def _check_convergence(rounds: int = 5000, edits: int = 600, seed: int = 1) -> None:
+    """
+    Check that concurrent edits converge: pairs of random edits transformed
+    past each other, then edits against stale revisions submitted to several
+    instances sharing one store of revisions.
+    """
+    global get_container, query_documents
+
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        text = "".join(rng.choice("abc") for _ in range(rng.randint(0, 8)))
+        a, b = _random_ops(rng, text), _random_ops(rng, text)
+        left = apply(apply(text, a), transform(b, "bo", a, "al"))
+        right = apply(apply(text, b), transform(a, "al", b, "bo"))
+        assert left == right, (text, a, b)
+
+    store = _RevisionStore()
+    get_container, query_documents = (lambda: store), store.query
+    instances = [TextState("", 0, "plan", "key") for _ in range(3)]
+    # (revision, text) pairs clients have seen and may still edit against
+    seen = [(0, "")]
+    for _ in range(edits):
+        state = rng.choice(instances)
+        by = rng.choice(("al", "bo", "cy"))
+        if rng.random() < 0.02:
+            text = "".join(rng.choice("abc") for _ in range(rng.randint(0, 8)))
+            seen.append((state.reset(text, by), text))
+            continue
+        base_rev, base_text = rng.choice(seen[-5:])
+        try:
+            _, rev, text = state.submit(_random_ops(rng, base_text), base_rev, by)
+        except StaleRevisionError:
+            continue
+        seen.append((rev, text))
+
+    # A new instance rebuilds the text past more than a page of revisions
+    instances.append(TextState("", 0, "plan", "key"))
+    for state in instances:
+        state.catch_up()
+        assert (state.rev, state.text) == seen[-1], (state.rev, seen[-1][0])
+    with_text = sum("text" in doc for doc in store.docs.values())
+    print(f"{rounds} transformed pairs converged")
+    print(
+        f"{len(instances)} instances converged on revision {seen[-1][0]}; "
+        f"{with_text} of {len(store.docs)} revisions stored the text"
+    )
+
+
+if __name__ == "__main__":
+    for n in (200, 2000, 10000):
+        _bandwidth_comparison(n)
+    _check_convergence()
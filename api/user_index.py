@@ -0,0 +1,128 @@
+"""
+Per-user plan index.
+
+Each user gets their own partition (`user|{user}`) holding one `userPlan`
+document per plan they created or took part in, so "my plans" is a
+single-partition read instead of a scan of every plan.
+"""
+import logging
+import time
+from typing import Optional
+
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+from storage import get_container, query_page, read_document
+
+# Only refresh an entry's lastActiveAt once per window per instance
+TOUCH_INTERVAL_MS = 10 * 60 * 1000
+MAX_TRACKED_ENTRIES = 10000
+
+LIST_QUERY = (
+    "SELECT c.planId, c.planName, c.role, c.createdAt, c.lastActiveAt FROM c "
+    "WHERE c.type='userPlan' ORDER BY c.lastActiveAt DESC"
+)
+# Entries of one plan across every user's partition
+PLAN_ENTRIES_QUERY = (
+    "SELECT c.plan, c.id FROM c WHERE c.type='userPlan' AND c.planId=@planId"
+)
+
+_last_touched = {}
+
+
+def user_partition(user: str) -> str:
+    return f"user|{user}"
+
+
+def user_plan_doc(
+    user: str, plan_id: str, role: str, plan_name: Optional[str], current_time: int
+) -> dict:
+    return {
+        "plan": user_partition(user),
+        "id": f"userPlan|{plan_id}",
+        "type": "userPlan",
+        "user": user,
+        "planId": plan_id,
+        "planName": plan_name,
+        "role": role,
+        "createdAt": current_time,
+        "lastActiveAt": current_time,
+    }
+
+
+def touch_user_plan(
+    user: Optional[str],
+    plan_id: Optional[str],
+    role: str = "participant",
+    plan_name: Optional[str] = None,
+) -> None:
+    """
+    Record that `user` acted on `plan_id`. Never raises; the index is best effort.
+    """
+    if not user or not plan_id:
+        return
+
+    current_time = int(time.time() * 1000)
+    key = (user, plan_id)
+    if current_time - _last_touched.get(key, 0) < TOUCH_INTERVAL_MS:
+        return
+    if len(_last_touched) >= MAX_TRACKED_ENTRIES:
+        _last_touched.clear()
+
+    try:
+        container = get_container()
+        doc = user_plan_doc(user, plan_id, role, plan_name, current_time)
+        if role == "owner":
+            container.upsert_item(doc)
+        else:
+            try:
+                container.patch_item(
+                    item=doc["id"],
+                    partition_key=doc["plan"],
+                    patch_operations=[
+                        {"op": "set", "path": "/lastActiveAt", "value": current_time}
+                    ],
+                )
+            except CosmosResourceNotFoundError:
+                # First action on the plan; the routes don't all know its name
+                plan_doc = read_document(plan_id, plan_id) or {}
+                doc["planName"] = plan_doc.get("planName")
+                container.upsert_item(doc)
+        _last_touched[key] = current_time
+    except Exception:
+        logging.exception(f"Failed to update plan index for user '{user}'")
+
+
+def forget_plan(plan_id: str) -> None:
+    """
+    Remove a deleted plan from every user's index. Never raises.
+    """
+    for key in [x for x in _last_touched if x[1] == plan_id]:
+        _last_touched.pop(key, None)
+    try:
+        container = get_container()
+        entries = list(
+            container.query_items(
+                PLAN_ENTRIES_QUERY,
+                parameters=[{"name": "@planId", "value": plan_id}],
+                enable_cross_partition_query=True,
+            )
+        )
+        for entry in entries:
+            try:
+                container.delete_item(entry["id"], partition_key=entry["plan"])
+            except CosmosResourceNotFoundError:
+                pass
+    except Exception:
+        logging.exception(f"Failed to remove plan '{plan_id}' from the plan index")
+
+
+def list_user_plans(
+    user: str, page_size: int, continuation_token: Optional[str] = None
+) -> dict:
+    """
+    Get one page of a user's plans, most recently active first.
+    """
+    plans, token = query_page(
+        user_partition(user), LIST_QUERY, page_size, continuation_token
+    )
+    return {"plans": plans, "continuationToken": token}
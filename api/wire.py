@@ -0,0 +1,154 @@
+"""
+MessagePack as an alternative to JSON for realtime messages and getPlan.
+
+JSON stays the default. A client opts in per channel:
+- HTTP: `Accept: application/x-msgpack` on `getPlan`; the same payload comes
+  back MessagePack-encoded (see streaming.py).
+- Hub: the `messagepack` SignalR hub protocol
+  (`@microsoft/signalr-protocol-msgpack`). Azure SignalR converts the
+  handlers' messages for such clients itself; the built-in hub (hub.py)
+  encodes each broadcast once per protocol in use.
+
+MessagePack needs the `msgpack` package; without it everything is JSON.
+
+Run `python wire.py` to compare encode/decode times and sizes of typical
+messages in both encodings.
+"""
+import json
+import time
+from typing import List
+
+import azure.functions as func
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, "application/msgpack", "application/vnd.msgpack")
+
+# SignalR hub protocols: text frames end with a record separator, binary
+# frames are prefixed with their length as a VarInt
+RECORD_SEPARATOR = "\x1e"
+PROTOCOLS = ("json", "messagepack") if msgpack else ("json",)
+
+
+def wants_msgpack(req: func.HttpRequest) -> bool:
+    accept = req.headers.get("Accept") or ""
+    return msgpack is not None and any(x in accept for x in MSGPACK_MIMETYPES)
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def hub_frame(protocol: str, message: dict):
+    """
+    One SignalR hub message (`{"type": ..., ...}` as in the JSON protocol)
+    framed for `protocol`: str for json, bytes for messagepack.
+    """
+    if protocol == "json":
+        return json.dumps(message) + RECORD_SEPARATOR
+    kind = message["type"]
+    if kind == 1:
+        fields = [1, {}, None, message["target"], message.get("arguments", [])]
+    elif kind == 7:
+        fields = [7, message.get("error"), False]
+    else:
+        fields = [kind]
+    body = msgpack.packb(fields)
+    return _varint(len(body)) + body
+
+
+def parse_hub_frames(protocol: str, data) -> List[list]:
+    """
+    Messages in a frame received from a client as `[type, ...]` arrays,
+    whatever the protocol (json ones are `[type, message]`).
+    """
+    if protocol == "json":
+        messages = (json.loads(x) for x in data.split(RECORD_SEPARATOR) if x.strip())
+        return [[x.get("type"), x] for x in messages]
+    messages = []
+    offset = 0
+    while offset < len(data):
+        length = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        messages.append(msgpack.unpackb(data[offset : offset + length]))
+        offset += length
+    return messages
+
+
+def _benchmark(iterations: int = 20000) -> None:
+    if msgpack is None:
+        raise SystemExit("The comparison needs msgpack: pip install msgpack")
+    voters = [f"Traveller {i}" for i in range(12)]
+    text = (
+        "Morning hike up to the ridge, lunch at the hut, then the long way "
+        "down past the lake. Bring water and layers. " * 4
+    )
+    messages = {
+        "activityUpdated": {
+            "target": "activityUpdated",
+            "arguments": [
+                {
+                    "activityText": text,
+                    "id": "3",
+                    "dateId": "2024-07-14",
+                    "isFinal": True,
+                    "byUser": "Traveller 0",
+                }
+            ],
+        },
+        "voteActivity": {
+            "target": "voteActivity",
+            "arguments": [
+                {
+                    "upVoters": voters[:8],
+                    "downVoters": voters[8:],
+                    "byUser": "Traveller 0",
+                    "id": "3",
+                    "dateId": "2024-07-14",
+                }
+            ],
+        },
+    }
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    print(
+        f"{'message':<16} {'protocol':<12} {'bytes':>6} {'encode µs':>10} {'decode µs':>10}"
+    )
+    for name, message in messages.items():
+        invocation = dict(message, type=1)
+        for protocol in PROTOCOLS:
+            frame = hub_frame(protocol, invocation)
+            size = len(frame.encode() if protocol == "json" else frame)
+            encode = timed(lambda: hub_frame(protocol, invocation))
+            decode = timed(lambda: parse_hub_frames(protocol, frame))
+            print(
+                f"{name:<16} {protocol:<12} {size:>6} {encode:>10.2f} {decode:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -173,7 +173,9 @@ function App() {
     const startSignalRConnection = async () => {
       try {
         // First, negotiate with the Azure Function
-        const response = await fetch(`/api/negotiate`);
+        const response = await fetch(
+          `/api/negotiate?userId=${encodeURIComponent(userName)}`
+        );
         if (!response.ok) {
           throw new Error(`Negotiation failed: ${response.statusText}`);
         }
@@ -192,7 +194,7 @@ function App() {
 
         // Register user
         const registerUser = await fetch(
-          `/api/registerUser?planId=${planId}&connectionId=${conn.connectionId}`
+          `/api/registerUser?planId=${planId}&connectionId=${conn.connectionId}&userName=${encodeURIComponent(userName)}`
         );
         if (!registerUser.ok) {
           const err = `Registering user failed: ${registerUser.statusText}`;